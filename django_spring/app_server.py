@@ -1,187 +1,819 @@
+import gc
 import logging
-import multiprocessing
 import os
-import queue
-import select
+import selectors
 import signal
+import socket
 import sys
 import time
 import traceback
+from collections import deque
 
 from django_spring.app_setup import setup_django
-from django_spring.utils.autoreload import python_reloader
+from django_spring.config import Config
+from django_spring.envs import is_pytest_env, is_test_env
+from django_spring.pytest_runner import prewarm_pytest, run_pytest
+from django_spring.runserver import use_held_socket
+from django_spring.test_cache import pop_force_flag, use_test_cache
+from django_spring.test_runner import prewarm_test_runner, use_forked_test_workers
+from django_spring.utils.autoreload import (
+    files_changed,
+    python_reloader,
+    start_reloader,
+    watched_paths,
+)
 from django_spring.utils.logger import colour, get_logger
-from django_spring.utils.processes import pid_is_alive, signal_handler
+from django_spring.utils.pool import WorkerPool
+from django_spring.utils.preload import preload, record_imported_modules
+from django_spring.utils.profiling import (
+    FirstWriteFile,
+    StartupProfile,
+    write_command_profile,
+)
+from django_spring.utils.processes import (
+    drain_fd,
+    exit_code_from_status,
+    FdEvent,
+    freeze_heap,
+    memory_usage,
+    reset_signal_wakeup,
+    signal_handler,
+    signal_wakeup_fd,
+)
 from django_spring.utils.socket_data import (
     bind,
     close,
     closing,
+    EXIT,
+    EXIT_STATUS,
+    FrameReader,
     read_json,
-    fd_redirect_list,
+    recv_fds,
+    Relay,
+    RESIZE,
+    send_fds,
+    STDERR,
+    STDIN,
+    STDOUT,
+    TERMINAL_SIZE,
+    write_all,
+    write_frame,
+    write_json,
 )
 from django_spring.utils.tty import FakeTTY
 
 
 class AppServer(object):
-    def __init__(self, restart_queued, path, app_env):
+    def __init__(
+        self, restart_queued, recycle_queued, path, app_env, ctl_sock=None, profile=None
+    ):
         self.app_env = app_env
+        self.runs_tests = is_test_env(app_env)
+        self.runs_pytest = is_pytest_env(app_env)
+        self.profile = profile or StartupProfile(app_env)
         self.app_sock = None
+        # Connects the app server to the manager, for READY, RESTART, IDLE, STOP
+        # and the files it watches for the app server
+        self.ctl_sock = ctl_sock
+        # When a command last ran, to tell the manager once it's been IDLE_TIMEOUT
+        self.last_active = time.monotonic()
+        self.idle_reported = False
+        # Set once the manager has switched over to a replacement
+        self.draining = False
+        self.stopping = False
+        self.selector = None
         self.log = get_logger("[APP - %s]" % app_env)
         self.path = path
         self.restart_queued = restart_queued
+        self.recycle_queued = recycle_queued
         self.command_worker_ctls = {}
+        self.pool = WorkerPool(
+            self.command_worker, Config.WORKER_POOL_SIZE, inherited=self._held_fds
+        )
+        # Connections accepted but not read from yet
+        self.pending_socks = []
+        # The manager's connections that it sends every command and control message over
+        self.pooled_socks = []
+        # Commands waiting for one of the running ones to finish
+        self.queued_commands = deque()
 
     def run(self):
         self.log("START", logging.WARN)
         try:
-            with bind(self.path) as self.app_sock:
-                setup_django(self.app_env)
+            with bind(self.path) as self.app_sock, signal_wakeup_fd(
+                signal.SIGCHLD
+            ) as child_exit_fd, selectors.DefaultSelector() as self.selector:
+                with self.profile.phase("setup_django"):
+                    setup_django(self.app_env)
+                with self.profile.phase("warm_up"):
+                    self._warm_up()
+                if Config.GC_FREEZE:
+                    with self.profile.phase("freeze_heap"):
+                        freeze_heap()
+                    gc.enable()
+                # The workers mustn't inherit the timed imports and `ready()`
+                self.profile.uninstall()
+                with self.profile.phase("fork_workers"):
+                    self.pool.fill()
+                self.profile.write()
                 self.log("READY", logging.WARN)
-                self.app_sock.listen(1)
-
-                while not self.restart_queued.is_set():
-                    ins, _, _ = select.select([self.app_sock], [], [], 1)
-                    if ins:
-                        client_sock, _ = ins[0].accept()
-                        ins, _, _ = select.select([client_sock], [], [])
-                        data = read_json(ins[0])
-                        self._handle_data(data, client_sock)
+                self.app_sock.listen(Config.LISTEN_BACKLOG)
+
+                self.selector.register(self.app_sock, selectors.EVENT_READ, self._accept)
+                self.selector.register(
+                    child_exit_fd, selectors.EVENT_READ, self._reap_workers
+                )
+                self.selector.register(
+                    self.recycle_queued, selectors.EVENT_READ, self._recycle_workers
+                )
+                self.selector.register(
+                    self.restart_queued, selectors.EVENT_READ, self._restart
+                )
+                if self.ctl_sock:
+                    self.selector.register(
+                        self.ctl_sock, selectors.EVENT_READ, self._handle_manager_ctl
+                    )
+                    if Config.SHARED_WATCHER:
+                        self._watch_code()
+                    write_json(
+                        {"app_ctl": "READY", "pool_size": self.pool.size}, self.ctl_sock
+                    )
+                self.last_active = time.monotonic()
+
+                while not self.stopping:
+                    for key, _ in self.selector.select(self._idle_timeout()):
+                        key.data(key.fileobj)
+                    self._dispatch_queued_commands()
+                    if self.draining:
+                        if not (
+                            self.pool.busy or self.queued_commands or self.pending_socks
+                        ):
+                            self.stopping = True
+                    else:
+                        # Refill only after handing off so the client isn't kept waiting
+                        self.pool.fill()
+                        self._check_idle()
         except KeyboardInterrupt:
             pass
         finally:
+            self.pool.close()
+            close(self.pending_socks + self.pooled_socks)
+            for _, fds in self.queued_commands:
+                close(fds)
             self.log("DONE", logging.WARN)
 
-    def _handle_data(self, data, client_sock):
-        if "command" in data:
-            ctl_queue = self.command_worker_ctls[
-                data["client_id"]
-            ] = multiprocessing.Manager().Queue()
-            p = multiprocessing.Process(
-                target=self.command_worker,
-                args=(data["command"], client_sock, ctl_queue),
+    def _warm_up(self):
+        """
+        Work done here before the workers are forked is shared by every command
+        """
+        self.profile.preloaded = preload(self.app_env)
+        if self.runs_tests and Config.FORK_PARALLEL_TESTS:
+            use_forked_test_workers()
+        if self.runs_tests and Config.TEST_CACHE:
+            use_test_cache()
+        if self.runs_tests and Config.HOT_TEST:
+            prewarm_test_runner()
+        if self.runs_pytest:
+            prewarm_pytest()
+
+    def _accept(self, app_sock):
+        client_sock, _ = app_sock.accept()
+        self.pending_socks.append(client_sock)
+        self.selector.register(client_sock, selectors.EVENT_READ, self._handle_client)
+
+    def _reap_workers(self, child_exit_fd):
+        drain_fd(child_exit_fd)
+        for worker in self.pool.reap():
+            self.command_worker_ctls.pop(worker.client_id, None)
+            worker.reloadable = False
+            self._report_command(
+                "COMMAND_FINISHED", runtime=time.monotonic() - worker.acquired
+            )
+        self.last_active = time.monotonic()
+
+    def _idle_timeout(self):
+        """
+        - returns how long until the app server has been idle for IDLE_TIMEOUT,
+        or None if it doesn't need to wake up for that
+        """
+        if (
+            not Config.IDLE_TIMEOUT
+            or not self.ctl_sock
+            or self.draining
+            or self.idle_reported
+        ):
+            return None
+        return max(0, self.last_active + Config.IDLE_TIMEOUT - time.monotonic())
+
+    def _check_idle(self):
+        if self.pool.busy or self.queued_commands or self.pending_socks:
+            self.last_active = time.monotonic()
+            self.idle_reported = False
+        elif self._idle_timeout() == 0:
+            # The manager decides whether to stop it, a command may be on its way
+            self.log("idle for %ss" % Config.IDLE_TIMEOUT, logging.WARN)
+            write_json({"app_ctl": "IDLE"}, self.ctl_sock)
+            self.idle_reported = True
+
+    def _restart(self, restart_queued):
+        self.selector.unregister(restart_queued)
+        if self.ctl_sock:
+            write_json(
+                {
+                    "app_ctl": "RESTART",
+                    "reason": restart_queued.reason,
+                    "standby": Config.STANDBY_RESTART,
+                },
+                self.ctl_sock,
+            )
+        if Config.STANDBY_RESTART and self.ctl_sock:
+            # Commands keep running on the old code until the replacement is ready
+            self.log("waiting for the standby app server", logging.WARN)
+        else:
+            self.stopping = True
+
+    def _handle_manager_ctl(self, ctl_sock):
+        try:
+            data = read_json(ctl_sock)
+        except ValueError:
+            # The manager has gone away
+            self.selector.unregister(ctl_sock)
+            self.stopping = True
+            return
+        if data["app_ctl"] == "STOP":
+            self.log("stopping once running commands finish", logging.WARN)
+            self.draining = True
+            self.pool.close()
+            self._reload_commands()
+        elif data["app_ctl"] == "FILES_CHANGED":
+            files_changed(data["paths"], self.restart_queued, self.recycle_queued)
+        elif data["app_ctl"] == "WATCH_UNAVAILABLE":
+            start_reloader(
+                self.restart_queued, self.recycle_queued, self.app_env, setup=False
+            )
+
+    def _reload_commands(self):
+        """
+        Stops the commands that their client runs again on the replacement
+        app server (eg. `runserver`), rather than waiting for them to finish
+        """
+        for worker in self.pool.busy.values():
+            if worker.reloadable:
+                write_json(
+                    {"command_ctl": "RELOAD", "client_id": worker.client_id}, worker.sock
+                )
+
+    def _watch_code(self):
+        """
+        Has the manager watch the files this app server imported,
+        it sends FILES_CHANGED when they change
+        """
+        try:
+            files, globs = watched_paths()
+        except ImportError:
+            # Django < 2.2 has no reloader to ask
+            start_reloader(
+                self.restart_queued, self.recycle_queued, self.app_env, setup=False
             )
-            p.start()
+            return
+        write_json({"app_ctl": "WATCH", "files": files, "globs": globs}, self.ctl_sock)
+
+    def _recycle_workers(self, recycle_queued):
+        recycle_queued.clear()
+        self.log("code changed, replacing idle workers", logging.WARN)
+        self.pool.recycle()
+
+    def _held_fds(self):
+        """
+        - returns the connections and the clients' descriptors the app server
+        holds for the commands it hasn't handed to a worker yet
+        """
+        fds = self.pending_socks + self.pooled_socks
+        for _, command_fds in self.queued_commands:
+            fds = fds + command_fds
+        return fds
+
+    def _has_capacity(self):
+        max_commands = Config.MAX_CONCURRENT_COMMANDS
+        return max_commands <= 0 or len(self.pool.busy) < max_commands
+
+    def _handle_client(self, client_sock):
+        self.selector.unregister(client_sock)
+        self.pending_socks.remove(client_sock)
+        try:
+            data = read_json(client_sock)
+        except ValueError:
+            # could be empty string if the client disconnects
+            client_sock.close()
+            return
+
+        if data.get("connection") == "pooled":
+            # The manager sends every message over it, until it closes it
+            self.pooled_socks.append(client_sock)
+            self.selector.register(
+                client_sock, selectors.EVENT_READ, self._handle_pooled
+            )
+            return
+        with closing(client_sock):
+            self._handle_message(data, client_sock)
+
+    def _handle_pooled(self, pooled_sock):
+        try:
+            data = read_json(pooled_sock)
+        except ValueError:
+            self.selector.unregister(pooled_sock)
+            self.pooled_socks.remove(pooled_sock)
+            pooled_sock.close()
+            return
+        self._handle_message(data, pooled_sock)
+
+    def _handle_message(self, data, sock):
+        if "command" in data:
+            if Config.PROFILE:
+                data.setdefault("timings", {})["received"] = time.time()
+            # The manager hands over the client's own socket after the command,
+            # followed by its stdin, stdout and stderr if it passes them, and
+            # the socket a reloadable `runserver` gets its listening socket through
+            fds = recv_fds(sock, 5)
+            if not fds:
+                return
+            self.queued_commands.append((data, fds))
+            if not self._has_capacity():
+                self.log(
+                    "%s commands running, queueing `%s`"
+                    % (len(self.pool.busy), data["command"]),
+                    logging.WARN,
+                )
         elif "command_ctl" in data:
-            ctl_queue = self.command_worker_ctls[data["client_id"]]
-            ctl_queue.put(data)
-
-    def _command_worker_target(self, cmd, p2cr, c2pw):
-        sys.stdin = os.fdopen(p2cr, "r", 1)
-        # Not really sure why it can't be unbuffered
-        # But the other end of the pipe receives no data after a select
-        sys.stdout = sys.stderr = FakeTTY(os.fdopen(c2pw, "w", 1))
-        # Some libraries write directly to file descriptors
-        os.dup2(c2pw, 1)
-        os.dup2(c2pw, 2)
+            self._handle_ctl(data)
+
+    def _handle_ctl(self, data):
+        client_id = data["client_id"]
+        # The worker reads control messages from the same socket it got its job from
+        worker = self.command_worker_ctls.get(client_id)
+        if worker:
+            write_json(data, worker.sock)
+            return
+
+        for queued in self.queued_commands:
+            if queued[0]["client_id"] == client_id:
+                self.log("dropping queued command `%s`" % queued[0]["command"])
+                self.queued_commands.remove(queued)
+                try:
+                    # The first descriptor is the client's socket
+                    write_frame(
+                        queued[1][0], EXIT, EXIT_STATUS.pack(-data.get("signal", 0))
+                    )
+                except OSError:
+                    pass
+                close(queued[1])
+                break
+
+    def _dispatch_queued_commands(self):
+        while self.queued_commands and self._has_capacity():
+            # Acquired while the command is still queued, so that a worker
+            # forked for it closes its descriptors too
+            worker = self.pool.acquire()
+            data, fds = self.queued_commands.popleft()
+            try:
+                worker.acquired = time.monotonic()
+                worker.client_id = data["client_id"]
+                worker.reloadable = data.get("reloadable", False)
+                self.command_worker_ctls[worker.client_id] = worker
+                if Config.PROFILE:
+                    timings = data.setdefault("timings", {})
+                    if worker.forked >= timings["received"]:
+                        # None was idle, it was forked for this command
+                        timings["forked"] = worker.forked
+                    timings["dispatched"] = time.time()
+                write_json(data, worker.sock)
+                send_fds(worker.sock, fds)
+            finally:
+                # Only close our copies, the worker now owns them
+                close(fds)
+            if "accepted" in data:
+                self._report_command(
+                    "COMMAND_STARTED", dispatch=time.time() - data["accepted"]
+                )
+
+    def _report_command(self, event, **data):
+        """
+        Tells the manager about a command starting or finishing, for its metrics
+        """
+        if not self.ctl_sock:
+            return
+        data.update(
+            app_ctl=event,
+            active=len(self.pool.busy),
+            queued=len(self.queued_commands),
+        )
+        try:
+            write_json(data, self.ctl_sock)
+        except OSError:
+            # The manager has gone away, `_handle_manager_ctl` deals with that
+            pass
+
+    def _command_worker_target(self, start_sock, p2cr, c2pw, e2pw):
         os.setsid()
+        reset_signal_wakeup()
+        try:
+            data = read_json(start_sock)
+        except ValueError:
+            # The worker went away without handing us a command
+            os._exit(0)
+        cmd = data["command"]
+        fds = recv_fds(start_sock, 4) if data["stdio"] or data["reloadable"] else []
+        stdio_fds = fds[:3] if data["stdio"] else []
+        listen_exchange = None
+        if data["reloadable"]:
+            listen_exchange = socket.socket(fileno=fds[-1])
+
+        if stdio_fds:
+            # Use the client's own stdin, stdout and stderr,
+            # so output goes straight to its terminal
+            for fd, stdio_fd in zip(stdio_fds, (0, 1, 2)):
+                os.dup2(fd, stdio_fd)
+            close(stdio_fds + [p2cr, c2pw, e2pw])
+            sys.stdin = os.fdopen(0, "r", closefd=False)
+            sys.stdout = os.fdopen(1, "w", 1, closefd=False)
+            sys.stderr = os.fdopen(2, "w", 1, closefd=False)
+        else:
+            sys.stdin = os.fdopen(p2cr, "r", 1)
+            # Not really sure why it can't be unbuffered
+            # But the other end of the pipe receives no data after a select
+            sys.stdout = FakeTTY(os.fdopen(c2pw, "w", 1))
+            # Kept apart so the client can write it to its own stderr
+            sys.stderr = FakeTTY(os.fdopen(e2pw, "w", 1))
+            # Some libraries write directly to file descriptors
+            os.dup2(c2pw, 1)
+            os.dup2(e2pw, 2)
+            _follow_terminal_size(start_sock, data.get("size"))
+
+        # `start_sock` stays open for reporting back to the worker
+        if Config.PROFILE:
+            _report_first_output(start_sock)
 
         exit_code = 0
         try:
             self.log(colour("running command `%s`" % cmd, "GREEN"), logging.WARN)
             try:
+                if listen_exchange:
+                    use_held_socket(listen_exchange)
                 command_execute(cmd)
             except KeyboardInterrupt:
                 pass
             except SystemExit as e:
-                exit_code = e.code
+                exit_code = _exit_code(e.code)
         except BaseException as e:
             exit_code = -1
             traceback.print_exc()
             self.log("command failed: %s" % e, logging.ERROR)
         finally:
-            os._exit(exit_code)
+            try:
+                record_imported_modules(self.app_env)
+                if Config.GC_FREEZE or Config.PROFILE:
+                    write_json({"memory": memory_usage()}, start_sock)
+            finally:
+                os._exit(exit_code)
 
-    def command_worker(self, cmd, client_sock, ctl_queue):
-        with closing(client_sock):
-            p2cr, p2cw = os.pipe()
-            c2pr, c2pw = os.pipe()
-            child = multiprocessing.Process(
-                target=self._command_worker_target,
-                kwargs=dict(cmd=cmd, p2cr=p2cr, c2pw=c2pw),
+    def command_worker(self, job_sock):
+        """
+        Runs in a pooled process forked from the app server
+
+        The command child is forked straight away as well, so when a job
+        arrives it only needs to be told which command to run
+        """
+        self.app_sock.close()
+        if self.ctl_sock:
+            self.ctl_sock.close()
+        p2cr, p2cw = os.pipe()
+        c2pr, c2pw = os.pipe()
+        e2pr, e2pw = os.pipe()
+        start_sock, child_start_sock = socket.socketpair()
+        child_pid = os.fork()
+        if child_pid == 0:
+            close([job_sock, p2cw, c2pr, e2pr, start_sock])
+            self._command_worker_target(child_start_sock, p2cr, c2pw, e2pw)
+        close([p2cr, c2pw, e2pw, child_start_sock])
+
+        try:
+            data = read_json(job_sock)
+        except ValueError:
+            # The app server went away, closing `start_sock` lets the child exit
+            close([job_sock, p2cw, c2pr, e2pr, start_sock])
+            return
+        fds = recv_fds(job_sock, 5)
+        client_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0, fds[0])
+        command_fds = fds[1:]
+
+        timings = data.get("timings", {})
+
+        with closing(client_sock), closing(job_sock), closing(start_sock):
+            timings["started"] = time.time()
+            write_json(
+                {
+                    "command": data["command"],
+                    "stdio": data.get("stdio", False),
+                    "reloadable": data.get("reloadable", False),
+                    "size": data.get("size"),
+                },
+                start_sock,
             )
-            child.start()
+            if command_fds:
+                send_fds(start_sock, command_fds)
+                close(command_fds)
 
             self.log("waiting on child", logging.WARN)
-            close([p2cr, c2pw])
-
+            exit_code = None
             try:
-                if self.child_wait_sigterm_handler(
-                    client_sock, child.pid, ctl_queue, p2cw, c2pr
-                ):
-                    self.log("child is gone, returning", logging.WARN)
-                    return
-                try:
-                    pid, status = os.waitpid(child.pid, 0)
-                except OSError:
-                    self.log("child is gone", logging.WARN)
+                status, sig = self.child_wait_sigterm_handler(
+                    client_sock, child_pid, job_sock, start_sock, p2cw, c2pr, e2pr
+                )
+                if sig:
+                    exit_code = -sig
+                    self.log("child killed with signal %s" % sig, logging.WARN)
                     return
 
-                exit_code = os.WEXITSTATUS(status)
+                exit_code = exit_code_from_status(status)
                 c = "GREEN" if exit_code == 0 else "RED"
                 self.log(
                     colour("child returned with status %s" % exit_code, c), logging.WARN
                 )
             finally:
+                if exit_code is not None:
+                    try:
+                        write_frame(client_sock, EXIT, EXIT_STATUS.pack(exit_code))
+                    except OSError:
+                        # The client has gone away
+                        pass
+                reports = _read_child_reports(start_sock)
+                if reports.get("memory"):
+                    self.log(
+                        "child used {rss_kb}kB, {shared_kb}kB shared "
+                        "and {private_kb}kB private".format(**reports["memory"]),
+                        logging.WARN,
+                    )
+                if Config.PROFILE:
+                    timings["exited"] = time.time()
+                    if "first_output" in reports:
+                        timings["first_output"] = reports["first_output"]
+                    write_command_profile(
+                        data["command"],
+                        self.app_env,
+                        exit_code,
+                        timings,
+                        reports.get("memory"),
+                    )
                 self.log("EXITING PARENT command_worker PROCESS")
-                close([p2cw, c2pr])
 
-    def child_wait_sigterm_handler(self, client_sock, child_pid, ctl_queue, p2cw, c2pr):
-        redirect_list = {client_sock: p2cw, c2pr: client_sock}
+    def child_wait_sigterm_handler(
+        self, client_sock, child_pid, ctl_sock, start_sock, p2cw, c2pr, e2pr
+    ):
+        """
+        Relays between the client and the child until the child exits,
+        killing it if asked to by a control message or SIGTERM
+
+        The child's stdout and stderr are sent to the client as STDOUT and STDERR
+        frames, and the client sends STDIN and RESIZE frames
+
+        - returns the child's wait status and the signal it was killed with, if any
+        - closes `p2cw`, `c2pr` and `e2pr` once done
+        """
+        output_fds = [c2pr, e2pr]
+        relay = Relay(
+            {c2pr: client_sock, e2pr: client_sock},
+            frame_types={c2pr: STDOUT, e2pr: STDERR},
+        )
+        client_frames = FrameReader(client_sock)
+        child = {"status": None}
+        open_fds = [p2cw, c2pr, e2pr]
+
+        def _close_stdin():
+            # Lets the child see EOF on its stdin
+            if p2cw in open_fds:
+                open_fds.remove(p2cw)
+                close([p2cw])
+
+        def _relay(fd_in):
+            try:
+                if relay(fd_in):
+                    return
+            except OSError:
+                # The other end has gone away
+                pass
+            selector.unregister(fd_in)
+
+        def _read_client(_client_sock):
+            try:
+                frames = client_frames.read()
+            except OSError:
+                frames = None
+            if frames is None:
+                selector.unregister(client_sock)
+                _close_stdin()
+                return
+            for frame_type, _, payload in frames:
+                if frame_type == STDIN and not payload:
+                    _close_stdin()
+                elif frame_type == STDIN and p2cw in open_fds:
+                    try:
+                        write_all(p2cw, payload)
+                    except OSError:
+                        # The child closed its stdin
+                        _close_stdin()
+                elif frame_type == RESIZE:
+                    write_json({"resize": TERMINAL_SIZE.unpack(payload)}, start_sock)
+                    try:
+                        os.kill(child_pid, signal.SIGWINCH)
+                    except OSError:
+                        pass
+
+        def _check_child(child_exit_fd):
+            drain_fd(child_exit_fd)
+            pid, status = os.waitpid(child_pid, os.WNOHANG)
+            if pid == child_pid:
+                child["status"] = status
+
+        def _check_ctl(_ctl_sock):
+            try:
+                ctl_data = read_json(ctl_sock)
+            except ValueError:
+                # The app server has gone away, the command keeps running
+                selector.unregister(ctl_sock)
+                return
+            if ctl_data["command_ctl"] == "QUIT":
+                self.log("got control data: %s" % ctl_data)
+                return ctl_data["signal"]
+            if ctl_data["command_ctl"] == "RELOAD":
+                self.log("stopping the command for its client to run it again")
+                try:
+                    write_json({"reload": True}, client_sock)
+                except OSError:
+                    pass
+                return signal.SIGTERM
+
+        def _wait(timeout=None):
+            """
+            Handles events until the child exits or `timeout` passes
+
+            - returns the signal to kill the child with, if one was asked for
+            """
+            while child["status"] is None:
+                if handler.handled:
+                    return handler.handled
+                events = selector.select(timeout)
+                if not events:
+                    return
+                for key, _ in events:
+                    sig = key.data(key.fileobj)
+                    if sig:
+                        return sig
+            # Flush whatever the child wrote before exiting
+            for fd in output_fds:
+                while fd in selector.get_map():
+                    if not any(key.fileobj == fd for key, _ in selector.select(0)):
+                        break
+                    _relay(fd)
 
         def _kill_child(sig):
             self.log("killing child process with sig %s" % sig, logging.WARN)
+            handler.handled = None
             # This is hacky, but nose ignores the first one
             # We can fix this pretty easily if this causes issues
-            os.killpg(child_pid, sig)
-            time.sleep(1)
-            os.killpg(child_pid, sig)
-
-            while pid_is_alive(child_pid):
-                ins, _, _ = select.select(redirect_list.keys(), [], [], 1)
-                if ins:
-                    if not fd_redirect_list(ins, redirect_list):
-                        break
+            for _ in range(2):
+                try:
+                    os.killpg(child_pid, sig)
+                except OSError:
+                    break
+                _wait(timeout=1)
+                if child["status"] is not None:
+                    break
+            while child["status"] is None:
+                _wait()
+
+        with signal_handler(signal.SIGTERM) as handler, signal_wakeup_fd(
+            signal.SIGCHLD
+        ) as child_exit_fd, selectors.DefaultSelector() as selector:
+            for fd in output_fds:
+                selector.register(fd, selectors.EVENT_READ, _relay)
+            selector.register(client_sock, selectors.EVENT_READ, _read_client)
+            selector.register(ctl_sock, selectors.EVENT_READ, _check_ctl)
+            selector.register(child_exit_fd, selectors.EVENT_READ, _check_child)
+            # The child may have exited before SIGCHLD could be caught
+            _check_child(child_exit_fd)
 
-        def _check_ctl():
             try:
-                ctl_data = ctl_queue.get_nowait()
-                if ctl_data["command_ctl"] == "QUIT":
-                    self.log("got control data: %s" % ctl_data)
-                    _kill_child(ctl_data["signal"])
-                    return ctl_data["signal"]
-            except queue.Empty:
-                return False
-
-        with signal_handler(signal.SIGTERM) as handler:
-            while pid_is_alive(child_pid):
-                check_ctl_ret = _check_ctl()
-                if check_ctl_ret:
-                    return check_ctl_ret
+                sig = _wait()
+                if sig:
+                    _kill_child(sig)
+                return child["status"], sig
+            finally:
+                close(open_fds)
+
+
+def _exit_code(code):
+    """
+    - returns the exit status for `sys.exit(code)`, like the interpreter does
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write("%s\n" % code)
+    return 1
 
-                if handler.handled:
-                    _kill_child(handler.handled)
-                    return handler.handled
-                else:
-                    ins, _, _ = select.select(redirect_list.keys(), [], [], 1)
-                    if not ins:
-                        continue
-                    if not fd_redirect_list(ins, redirect_list):
-                        continue
+
+def _follow_terminal_size(start_sock, size):
+    """
+    The command writes to pipes rather than the client's terminal, so it is
+    told the terminal's size through COLUMNS and LINES. The worker sends the
+    new size and a SIGWINCH whenever the client's terminal is resized
+    """
+
+    def _set_size(size):
+        if size:
+            os.environ["COLUMNS"], os.environ["LINES"] = str(size[0]), str(size[1])
+
+    def _resized(_sig, _frame):
+        start_sock.setblocking(False)
+        try:
+            while True:
+                _set_size(read_json(start_sock).get("resize"))
+        except (BlockingIOError, ValueError):
+            pass
+        finally:
+            start_sock.setblocking(True)
+
+    _set_size(size)
+    signal.signal(signal.SIGWINCH, _resized)
+
+
+def _report_first_output(start_sock):
+    """
+    Tells the worker when the command first writes to stdout or stderr
+    """
+    reported = []
+
+    def _first_output():
+        if not reported:
+            reported.append(True)
+            write_json({"first_output": time.time()}, start_sock)
+
+    sys.stdout = FirstWriteFile(sys.stdout, _first_output)
+    sys.stderr = FirstWriteFile(sys.stderr, _first_output)
+
+
+def _read_child_reports(start_sock):
+    """
+    - returns everything the exited child reported back, merged together
+    """
+    reports = {}
+    start_sock.setblocking(False)
+    while True:
+        try:
+            reports.update(read_json(start_sock))
+        except (BlockingIOError, ValueError):
+            # Nothing more was sent, or the child was killed
+            return reports
 
 
 def command_execute(cmd):
     from django.core import management
 
-    sys.argv = ["spring"] + cmd.split(" ")
+    args = pop_force_flag(cmd.split(" "))
+    if args[0] == "pytest":
+        return run_pytest(args[1:])
+    sys.argv = ["spring"] + args
     return management.ManagementUtility(sys.argv).execute()
 
 
 if __name__ == "__main__":
-    from threading import Event
-
-    restart_queued = Event()
+    if Config.GC_FREEZE:
+        # Collecting during startup leaves holes in pages that later objects fill,
+        # the heap is collected once before forking instead
+        gc.disable()
+    restart_queued = FdEvent()
+    recycle_queued = FdEvent()
     app_env = sys.argv[2]
+    # Started before the reloader thread, which also sets up django
+    profile = StartupProfile(app_env, enabled=Config.PROFILE)
+    profile.install()
+    ctl_sock = None
+    if len(sys.argv) > 3:
+        ctl_sock = socket.socket(fileno=int(sys.argv[3]))
     app_server = AppServer(
-        restart_queued=restart_queued, path=sys.argv[1], app_env=app_env
+        restart_queued=restart_queued,
+        recycle_queued=recycle_queued,
+        path=sys.argv[1],
+        app_env=app_env,
+        ctl_sock=ctl_sock,
+        profile=profile,
+    )
+    python_reloader(
+        app_server.run,
+        restart_queued,
+        recycle_queued,
+        app_env,
+        # Otherwise the manager watches the code for it
+        watch=not (ctl_sock and Config.SHARED_WATCHER),
     )
-    python_reloader(app_server.run, restart_queued, app_env)
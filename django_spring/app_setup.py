@@ -4,6 +4,7 @@ import traceback
 from contextlib import contextmanager
 
 from django_spring.config import Config
+from django_spring.envs import is_test_env
 
 
 def app_default_pre_setup_hook():
@@ -42,13 +43,14 @@ def simplify_logging_handlers():
 @contextmanager
 def wrap_env(app_env):
     """
-    If app_env is "test" then make django load the test settings file
+    If app_env runs tests then make django load the test settings file
     """
-    if app_env == "test":
+    runs_tests = is_test_env(app_env)
+    if runs_tests:
         argv = sys.argv[:]
         sys.argv.append("test")
     yield
-    if app_env == "test":
+    if runs_tests:
         sys.argv = argv
 
 
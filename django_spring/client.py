@@ -1,15 +1,37 @@
 import os
 import select
 import signal
+import json
+import logging
+import socket
 import sys
+import threading
+import time
 import uuid
 
 from django_spring.config import Config
+from django_spring.envs import env_for_command, load_envs
 from django_spring.utils.logger import get_logger, TERM_COLORS
+from django_spring.utils.metrics import render_prometheus
+from django_spring.utils.processes import drain_fd, signal_wakeup_fd
 from django_spring.utils.socket_data import (
     closing,
     connect,
-    fd_redirect_list,
+    CONTROL,
+    EXIT,
+    EXIT_STATUS,
+    FrameReader,
+    MIN_READ_SIZE,
+    read_json,
+    recv_fds,
+    RESIZE,
+    send_fds,
+    STDERR,
+    STDIN,
+    STDOUT,
+    TERMINAL_SIZE,
+    write_all,
+    write_frame,
     write_json,
 )
 
@@ -21,36 +43,100 @@ class Client(object):
         self.ctl_path = ctl_path
         self.app_env = app_env
         self.client_id = str(uuid.uuid1())
+        self.frames = None
+        self.stdin_open = not Config.PASS_STDIO
+        # Sent in an EXIT frame once the command is done
+        self.exit_status = None
+        # Set when the command was stopped for us to run it again
+        self.reload = False
 
-    def _redirect_until_socket_breaks(self, redirect_map, ignore_sigint=False):
-        read_sizes = {sys.stdin: 1}
-        while True:
-            try:
-                ins, _, _ = select.select(redirect_map.keys(), [], [])
-                if not fd_redirect_list(ins, redirect_map, read_sizes):
-                    break
-            except KeyboardInterrupt:
-                if not ignore_sigint:
-                    raise
+    def _write_output(self, frames):
+        for frame_type, _, payload in frames:
+            if frame_type == STDOUT:
+                write_all(sys.stdout.fileno(), payload)
+            elif frame_type == STDERR:
+                write_all(sys.stderr.fileno(), payload)
+            elif frame_type == EXIT:
+                (self.exit_status,) = EXIT_STATUS.unpack(payload)
+            elif frame_type == CONTROL and json.loads(payload.decode()).get("reload"):
+                self.reload = True
+
+    def _send_terminal_size(self, data_sock):
+        size = _terminal_size()
+        if size:
+            write_frame(data_sock, RESIZE, TERMINAL_SIZE.pack(*size))
+
+    def _relay_until_exit(self, data_sock, ignore_sigint=False):
+        """
+        Writes the command's output to our stdout and stderr and, unless the
+        command uses them itself, sends it our stdin and terminal size
 
-    def run(self, cmd):
-        # unbuffered STDIN
-        sys.stdin = os.fdopen(sys.stdin.fileno(), "rb", 0)
+        - returns the command's exit status once the app server is done with
+        us, or None if the connection broke before it was sent
+        """
+        with signal_wakeup_fd(signal.SIGWINCH) as resize_fd:
+            inputs = [data_sock]
+            if self.stdin_open:
+                inputs += [sys.stdin, resize_fd]
+            while True:
+                try:
+                    ins, _, _ = select.select(inputs, [], [])
+                    for fd in ins:
+                        if fd is data_sock:
+                            frames = self.frames.read()
+                            if frames is None:
+                                return self.exit_status
+                            self._write_output(frames)
+                        elif fd is resize_fd:
+                            drain_fd(resize_fd)
+                            self._send_terminal_size(data_sock)
+                        else:
+                            data = os.read(sys.stdin.fileno(), MIN_READ_SIZE)
+                            write_frame(data_sock, STDIN, data)
+                            if not data:
+                                # The command sees EOF on its stdin but its output keeps coming
+                                self.stdin_open = False
+                                inputs = [data_sock]
+                except KeyboardInterrupt:
+                    if not ignore_sigint:
+                        raise
+
+    def run(self, cmd, listen_exchange=None):
+        """
+        Runs `cmd`, which gets the other end of `listen_exchange`
+        if it can be reloaded, see `run_reloading`
+
+        - returns the command's exit status, None if it never came
+        """
+        # unbuffered STDIN, kept open for the next command
+        sys.stdin = os.fdopen(sys.stdin.fileno(), "rb", 0, closefd=False)
+        self.reload = False
         data_sock = connect(self.data_path)
         ctl_sock = connect(self.ctl_path)
+        self.frames = FrameReader(data_sock)
 
         with closing(data_sock), closing(ctl_sock):
-            redirect_map = {data_sock: sys.stdout, sys.stdin: data_sock}
             try:
-                write_json(
-                    {
-                        "command": cmd,
-                        "app_env": self.app_env,
-                        "client_id": self.client_id,
-                    },
-                    data_sock,
-                )
-                self._redirect_until_socket_breaks(redirect_map)
+                msg = {
+                    "command": cmd,
+                    "app_env": self.app_env,
+                    "client_id": self.client_id,
+                    "stdio": Config.PASS_STDIO,
+                    "reloadable": listen_exchange is not None,
+                }
+                if not Config.PASS_STDIO:
+                    msg["size"] = _terminal_size()
+                write_json(msg, data_sock)
+                fds = []
+                if Config.PASS_STDIO:
+                    # The command uses our stdin, stdout and stderr itself, so
+                    # the socket only tells us when it is done and how it went
+                    fds = [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()]
+                if listen_exchange:
+                    fds.append(listen_exchange.fileno())
+                if fds:
+                    send_fds(data_sock, fds)
+                return self._relay_until_exit(data_sock)
             except KeyboardInterrupt:
                 write_json(
                     {
@@ -61,24 +147,342 @@ class Client(object):
                     },
                     ctl_sock,
                 )
-                self._redirect_until_socket_breaks(redirect_map, ignore_sigint=True)
+                return self._relay_until_exit(data_sock, ignore_sigint=True)
+
+    def run_reloading(self, cmd):
+        """
+        Runs `runserver` again whenever it stops for the code to reload, see
+        `use_held_socket`. The listening socket is kept here in between,
+        so requests wait for the next run rather than being refused
+
+        - returns the exit status of the last run
+        """
+        listen_sock = None
+        try:
+            while True:
+                exchange, command_exchange = socket.socketpair()
+                with closing(exchange):
+                    if listen_sock:
+                        write_json({"listening": True}, exchange)
+                        send_fds(exchange, [listen_sock.fileno()])
+                    else:
+                        write_json({"listening": False}, exchange)
+                    try:
+                        exit_status = self.run(cmd, listen_exchange=command_exchange)
+                    finally:
+                        command_exchange.close()
+                    sent_sock, reload = _read_exchange(exchange)
+                listen_sock = listen_sock or sent_sock
+                # Its app server was replaced, or it asked to run again itself
+                if not (self.reload or reload):
+                    return exit_status
+                self.log("the code changed, running `%s` again" % cmd, logging.WARN)
+        finally:
+            if listen_sock:
+                listen_sock.close()
+
+
+class SessionCommand(object):
+    """
+    A command started with `Session.start`
+    """
+
+    def __init__(self, session, session_id, stdout, stderr):
+        self.session = session
+        self.session_id = session_id
+        self.stdout = stdout if stdout is not None else sys.stdout.buffer
+        self.stderr = stderr if stderr is not None else sys.stderr.buffer
+        self.done = False
+        # None if the connection broke before it was sent
+        self.exit_status = None
+
+    def _handle_frame(self, frame_type, payload):
+        if frame_type == STDOUT:
+            self.stdout.write(payload)
+        elif frame_type == STDERR:
+            self.stderr.write(payload)
+        elif frame_type == EXIT:
+            (self.exit_status,) = EXIT_STATUS.unpack(payload)
+            self.done = True
+
+    def write(self, data):
+        """
+        Writes `data` to the command's stdin, an empty one closes it
+        """
+        self.session._send(STDIN, data, self.session_id)
+
+    def interrupt(self, sig=signal.SIGINT):
+        self.session._send(
+            CONTROL,
+            json.dumps({"command_ctl": "QUIT", "signal": sig}).encode(),
+            self.session_id,
+        )
+
+    def wait(self):
+        """
+        Writes the command's output to its `stdout` and `stderr` until it exits
+
+        - returns its exit status, negative if it was killed by a signal
+        """
+        while not self.done:
+            # Whichever thread reads passes every command its output
+            with self.session.read_lock:
+                if not self.done:
+                    self.session._read()
+        return self.exit_status
+
+
+class Session(object):
+    """
+    Runs any number of commands over a single connection to the spring
+    server, for editor plugins and scripts that run many of them, eg.
+
+        with Session() as session:
+            exit_status = session.run("test app1.tests", stdout=output)
+
+    Commands started with `start` run at the same time
+    """
+
+    def __init__(self, path=None):
+        self.sock = connect(path or Config.MANAGER_SOCK_FILE, max_attempts=1)
+        write_json({"session": True}, self.sock)
+        self.frames = FrameReader(self.sock)
+        self.envs = load_envs()
+        # By session id, 0 is the session's own
+        self.commands = {}
+        self.next_session_id = 1
+        self.read_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Closes the connection, the commands still running are interrupted
+        """
+        self.sock.close()
+
+    def _send(self, frame_type, payload, session_id):
+        with self.write_lock:
+            write_frame(self.sock, frame_type, payload, session_id)
+
+    def _read(self):
+        frames = self.frames.read()
+        if frames is None:
+            # The spring server went away
+            for command in self.commands.values():
+                command.done = True
+            self.commands.clear()
+            return
+        for frame_type, session_id, payload in frames:
+            command = self.commands.get(session_id)
+            if command:
+                command._handle_frame(frame_type, payload)
+                if command.done:
+                    del self.commands[session_id]
+
+    def start(self, cmd, stdout=None, stderr=None, stdin=False, app_env=None):
+        """
+        Starts `cmd` (eg. "test app1") on the app server of `app_env`, by default
+        the one `spring <cmd>` runs on. Its output is written to the binary files
+        `stdout` and `stderr`, our own by default. Unless `stdin`, the command
+        sees EOF on its stdin right away, otherwise see `SessionCommand.write`
+
+        - returns the `SessionCommand`
+        """
+        if app_env is None:
+            app_env = env_for_command(self.envs, cmd.split(" "))
+        with self.write_lock:
+            session_id = self.next_session_id
+            self.next_session_id += 1
+            command = SessionCommand(self, session_id, stdout, stderr)
+            self.commands[session_id] = command
+            write_json(
+                {"command": cmd, "app_env": app_env, "client_id": str(uuid.uuid1())},
+                self.sock,
+                session_id,
+            )
+        if not stdin:
+            command.write(b"")
+        return command
+
+    def run(self, cmd, **kwargs):
+        """
+        Runs `cmd` like `start` does and waits for it
+
+        - returns its exit status
+        """
+        return self.start(cmd, **kwargs).wait()
+
+
+def _read_exchange(exchange):
+    """
+    - returns the listening socket `runserver` sent back over `exchange`
+    if it bound one, and whether it asked to be run again
+    """
+    listen_sock = None
+    reload = False
+    exchange.setblocking(False)
+    try:
+        while True:
+            msg = read_json(exchange)
+            if msg.get("listening"):
+                listen_sock = socket.socket(fileno=recv_fds(exchange, 1)[0])
+            reload = reload or msg.get("reload", False)
+    except (BlockingIOError, IndexError, ValueError):
+        return listen_sock, reload
+
+
+def _terminal_size():
+    try:
+        return list(os.get_terminal_size(sys.stdout.fileno()))
+    except OSError:
+        return None
+
+
+def _shell_exit_status(exit_status):
+    if exit_status is None:
+        # The app server went away before the command finished
+        return 1
+    if exit_status < 0:
+        # Killed by a signal, reported like shells do
+        return 128 - exit_status
+    return exit_status
 
 
 def start_client():
-    app_env = "test" if sys.argv[1] == "test" else "dev"
+    envs = load_envs()
+    app_env = env_for_command(envs, sys.argv[1:])
+    if app_env not in envs:
+        print(
+            "{}Unknown env `{}`, the envs are: {}{}".format(
+                TERM_COLORS["YELLOW"], app_env, ", ".join(sorted(envs)), TERM_COLORS["RESET"]
+            )
+        )
+        sys.exit(1)
     client = Client(
         data_path=Config.MANAGER_SOCK_FILE,
         ctl_path=Config.MANAGER_CTL_SOCK_FILE,
         app_env=app_env,
     )
+    args = sys.argv[1:]
     try:
-        client.run(" ".join(sys.argv[1:]))
+        if args[0] == "runserver" and "--noreload" not in args:
+            exit_status = client.run_reloading(" ".join(args))
+        else:
+            exit_status = client.run(" ".join(args))
     except ConnectionRefusedError:
         print(
             "{}Can't connect to the spring server, please run: `spring start`{}".format(
                 TERM_COLORS["YELLOW"], TERM_COLORS["RESET"]
             )
         )
+        sys.exit(1)
+    sys.exit(_shell_exit_status(exit_status))
+
+
+def _mb(kb):
+    return "%sMB" % (kb // 1024) if kb is not None else "-"
+
+
+def _ago(timestamp):
+    return "%ss ago" % int(time.time() - timestamp) if timestamp else "-"
+
+
+def _seconds(value):
+    return "%.3fs" % value if value is not None else "-"
+
+
+def _quantiles(histogram):
+    return "{} / {}".format(_seconds(histogram["p50"]), _seconds(histogram["p95"]))
+
+
+def print_status():
+    try:
+        ctl_sock = connect(Config.MANAGER_CTL_SOCK_FILE, max_attempts=1)
+    except socket.error:
+        print("The spring server isn't running")
+        sys.exit(1)
+    with closing(ctl_sock):
+        write_json({"manager_ctl": "STATUS"}, ctl_sock)
+        status = read_json(ctl_sock)
+
+    if "--json" in sys.argv:
+        print(json.dumps(status, indent=2))
+        return
+    if "--prometheus" in sys.argv:
+        sys.stdout.write(render_prometheus(status))
+        return
+    row = "{:<12} {:<18} {:<8} {:<8} {:<8} {:<8} {:<9}"
+    print(row.format("ENV", "STATE", "PID", "RSS", "MAX RSS", "MEMORY", "LAST USED"))
+    for name, env in status["envs"].items():
+        state = env["state"] + (" (pinned)" if env["pinned"] else "")
+        print(
+            row.format(
+                name,
+                state,
+                env["pid"] or "-",
+                _mb(env["rss_kb"]),
+                _mb(env["max_rss_kb"]),
+                _mb(env["memory_kb"]),
+                _ago(env["last_used"]),
+            )
+        )
+
+    row = "{:<12} {:<8} {:<6} {:<7} {:<7} {:<9} {:<20} {:<20}"
+    print(
+        "\n"
+        + row.format(
+            "ENV",
+            "BOOT",
+            "POOL",
+            "ACTIVE",
+            "QUEUED",
+            "COMMANDS",
+            "DISPATCH p50 / p95",
+            "RUNTIME p50 / p95",
+        )
+    )
+    for name, env in status["envs"].items():
+        print(
+            row.format(
+                name,
+                _seconds(env["boot_seconds"]),
+                env["pool_size"] or "-",
+                env["active_commands"],
+                env["queued_commands"],
+                env["command_seconds"]["count"],
+                _quantiles(env["dispatch_seconds"]),
+                _quantiles(env["command_seconds"]),
+            )
+        )
+    restarted = [(name, env) for name, env in status["envs"].items() if env["restarts"]]
+    if restarted:
+        print()
+    for name, env in restarted:
+        print(
+            "{} restarted {} times, last {}: {}".format(
+                name, env["restarts"], _ago(env["restarted"]), env["restart_reason"]
+            )
+        )
+    print(
+        "\nmemory available: {}, budget: {}".format(
+            _mb(status["mem_available_kb"]), _mb(status["memory_budget_kb"])
+        )
+    )
+    if status["decisions"]:
+        print("\nrecent decisions:")
+        for decision in status["decisions"]:
+            print(
+                "  {} {}".format(
+                    time.strftime("%H:%M:%S", time.localtime(decision["time"])),
+                    decision["decision"],
+                )
+            )
 
 
 if __name__ == "__main__":
@@ -1,11 +1,65 @@
+import importlib.util
 import os
 
 
+def _env_flag(name, default=False):
+    return os.environ.get(name, str(int(default))).lower() in ("1", "true", "yes")
+
+
 class Config(object):
     APP_SOCK_FILE = "/tmp/django_spring_app_{}.sock"
     CODE_RELOADER_POLL_PERIOD = int(os.environ.get("CODE_RELOADER_POLL_PERIOD", 5))
+    COLLECTION_CACHE = _env_flag("COLLECTION_CACHE")
     DJANGO_SETTINGS_MODULE = os.environ.get("DJANGO_SETTINGS_MODULE", "settings")
+    ENVS_FILE = os.environ.get("ENVS_FILE", "spring_envs.json")
+    FORK_PARALLEL_TESTS = _env_flag("FORK_PARALLEL_TESTS", default=True)
+    GC_FREEZE = _env_flag("GC_FREEZE")
+    HOT_TEST = _env_flag("HOT_TEST")
+    # In seconds, 0 to never stop idle app servers
+    IDLE_TIMEOUT = int(os.environ.get("IDLE_TIMEOUT", 1800))
+    LISTEN_BACKLOG = int(os.environ.get("LISTEN_BACKLOG", 128))
     LOG_LEVEL = os.environ.get("LOG_LEVEL", "WARN")
     MANAGER_SOCK_FILE = "/tmp/django_spring_manager.sock"
     MANAGER_CTL_SOCK_FILE = "/tmp/django_spring_manager_ctl.sock"
+    MAX_CONCURRENT_COMMANDS = int(os.environ.get("MAX_CONCURRENT_COMMANDS", 0))
+    # In MB, 0 for no limit, like MEMORY_BUDGET and MIN_MEM_AVAILABLE
+    MAX_RSS = int(os.environ.get("MAX_RSS", 0))
+    MEMORY_BUDGET = int(os.environ.get("MEMORY_BUDGET", 0))
+    # In seconds
+    MEMORY_CHECK_PERIOD = int(os.environ.get("MEMORY_CHECK_PERIOD", 10))
+    MIN_MEM_AVAILABLE = int(os.environ.get("MIN_MEM_AVAILABLE", 0))
+    MODULE_INDEX_EXCLUDE = os.environ.get(
+        "MODULE_INDEX_EXCLUDE", "__pycache__,node_modules,site-packages,*venv*"
+    )
+    MODULE_INDEX_FILE = "/tmp/django_spring_modules_{}.json"
+    PASS_STDIO = _env_flag("PASS_STDIO", default=True)
+    PRELOAD_EXCLUDE = os.environ.get("PRELOAD_EXCLUDE", "*.tests,*.tests.*,*.test_*")
+    PRELOAD_MODULES = os.environ.get("PRELOAD_MODULES", "")
+    PRELOAD_RECORD_FILE = "/tmp/django_spring_preload_{}.json"
+    PROFILE = _env_flag("PROFILE")
+    PROFILE_COMMANDS_FILE = "/tmp/django_spring_commands.jsonl"
+    PROFILE_STARTUP_FILE = "/tmp/django_spring_startup_{}.json"
     RESTART_EXIT_CODE = 3
+    SELECTIVE_RELOAD = _env_flag("SELECTIVE_RELOAD", default=True)
+    SHARED_WATCHER = _env_flag("SHARED_WATCHER", default=True)
+    STANDBY_RESTART = _env_flag("STANDBY_RESTART", default=True)
+    TEST_CACHE = _env_flag("TEST_CACHE")
+    TEST_CACHE_DIR = os.environ.get("TEST_CACHE_DIR", "/tmp/django_spring_test_cache")
+    # In MB
+    TEST_CACHE_MAX_SIZE = int(os.environ.get("TEST_CACHE_MAX_SIZE", 50))
+    WORKER_POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", 2))
+    ZYGOTE = _env_flag("ZYGOTE")
+    ZYGOTE_PRELOAD = os.environ.get("ZYGOTE_PRELOAD", "")
+
+
+def reload_config():
+    """
+    Reads the env vars again into `Config`, for a process whose environment
+    changed since it imported this module (eg. an app server forked by the zygote)
+    """
+    spec = importlib.util.find_spec(__name__)
+    fresh = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fresh)
+    for name, value in vars(fresh.Config).items():
+        if not name.startswith("__"):
+            setattr(Config, name, value)
@@ -0,0 +1,106 @@
+import json
+import os
+
+from django_spring.config import Config
+
+
+# Commands no env claims run here
+DEFAULT_ENV = "dev"
+# Commands that run the project's tests
+TEST_COMMANDS = ("test", "pytest")
+
+
+class AppEnv(object):
+    """
+    A named app server configuration: the settings module and environment
+    variables it starts with, the modules it preloads and the commands
+    that run on it unless the client picks another env
+
+    Envs start when a command first needs them and stop after
+    `idle_timeout` seconds without commands, unless `pinned`. An app
+    server whose RSS grows past `max_rss` is replaced
+    """
+
+    def __init__(
+        self,
+        name,
+        settings=None,
+        env=None,
+        preload=None,
+        commands=(),
+        pinned=False,
+        idle_timeout=None,
+        max_rss=None,
+    ):
+        self.name = name
+        self.settings = settings
+        self.env = env or {}
+        self.preload = preload
+        self.commands = list(commands)
+        self.pinned = pinned
+        self.idle_timeout = idle_timeout
+        # In MB, overrides MAX_RSS
+        self.max_rss = max_rss
+
+    @property
+    def runs_tests(self):
+        return any(command in self.commands for command in TEST_COMMANDS)
+
+    @property
+    def runs_pytest(self):
+        return "pytest" in self.commands
+
+    def environ(self, base):
+        """
+        - returns `base` with this env's settings applied, for its app server
+        """
+        environ = dict(base)
+        if self.settings:
+            environ["DJANGO_SETTINGS_MODULE"] = self.settings
+        if self.preload is not None:
+            environ["PRELOAD_MODULES"] = self.preload
+        if self.pinned:
+            environ["IDLE_TIMEOUT"] = "0"
+        elif self.idle_timeout is not None:
+            environ["IDLE_TIMEOUT"] = str(self.idle_timeout)
+        environ.update((key, str(value)) for key, value in self.env.items())
+        return environ
+
+
+def load_envs(path=None):
+    """
+    The "test" and "dev" envs always exist, ENVS_FILE can change
+    them and add others, eg.
+    {"ci": {"settings": "settings_ci", "env": {"CELERY_ALWAYS_EAGER": "1"}}}
+
+    - returns the envs by name
+    """
+    definitions = {"test": {"commands": list(TEST_COMMANDS)}, DEFAULT_ENV: {}}
+    path = path or Config.ENVS_FILE
+    if os.path.exists(path):
+        with open(path) as f:
+            for name, definition in json.load(f).items():
+                definitions[name] = dict(definitions.get(name, {}), **definition)
+    return {name: AppEnv(name, **definition) for name, definition in definitions.items()}
+
+
+def env_for_command(envs, args):
+    """
+    - returns the name of the env that the command in `args` runs on
+    """
+    if os.environ.get("SPRING_ENV"):
+        return os.environ["SPRING_ENV"]
+    for name, app_env in envs.items():
+        if args and args[0] in app_env.commands:
+            return name
+    return DEFAULT_ENV
+
+
+def is_test_env(name):
+    app_env = load_envs().get(name)
+    return bool(app_env and app_env.runs_tests)
+
+
+def is_pytest_env(name):
+    app_env = load_envs().get(name)
+    return bool(app_env and app_env.runs_pytest)
@@ -1,38 +1,65 @@
+import functools
+import json
 import logging
-import multiprocessing
 import os
 import select
+import selectors
 import signal
+import socket
 import subprocess
 import sys
 import threading
 import time
-
+from collections import deque
 
 from django_spring.config import Config
+from django_spring.envs import load_envs
+from django_spring.utils import inotify
 from django_spring.utils.logger import get_logger
-from django_spring.utils.processes import pid_is_alive
+from django_spring.utils.metrics import Histogram
+from django_spring.utils.processes import (
+    drain_fd,
+    FdEvent,
+    mem_available,
+    rss,
+    signal_wakeup_fd,
+    tree_memory,
+)
 from django_spring.utils.socket_data import (
     bind,
+    close,
     closing,
     connect,
+    CONTROL,
+    EXIT,
+    EXIT_STATUS,
+    FrameReader,
     read_json,
-    fd_redirect_list,
+    recv_fds,
+    send_fds,
+    STDERR,
+    write_frame,
     write_json,
 )
+from django_spring.zygote import Zygote
+
+
+class AppServerUnavailable(Exception):
+    """
+    The app server of an env exited before a command could be handed to it
+    """
 
 
 class ClientToAppControlThread(threading.Thread):
-    def __init__(self, app_servers, client_sock):
+    def __init__(self, manager, client_sock):
         threading.Thread.__init__(self)
-        self.app_servers, self.client_sock = app_servers, client_sock
+        self.manager, self.client_sock = manager, client_sock
 
     def send_msg(self, msg):
-        app_sock = connect(
-            self.app_servers[msg["app_env"]], wait_time=1, max_attempts=5
-        )
-        with closing(app_sock):
-            write_json(msg, app_sock)
+        if msg.get("manager_ctl") == "STATUS":
+            write_json(self.manager.status(), self.client_sock)
+            return
+        self.manager.send_ctl(msg)
 
     def run(self):
         log = get_logger("[CLIENT_CTL_THREAD]")
@@ -53,129 +80,879 @@ class ClientToAppControlThread(threading.Thread):
 
 
 class ClientToAppDataThread(threading.Thread):
-    def __init__(self, app_servers, client_sock):
+    def __init__(self, manager, client_sock):
         threading.Thread.__init__(self)
-        self.app_servers, self.client_sock = app_servers, client_sock
+        self.manager, self.client_sock = manager, client_sock
+        self.accepted = time.time()
 
     def run(self):
         log = get_logger("[CLIENT_DATA_THREAD]")
         log("START")
 
         try:
-            with closing(self.client_sock):
-                ins, _, _ = select.select([self.client_sock], [], [])
-                if ins:
-                    msg = read_json(ins[0])
-                    app_env = msg["app_env"]
-                    app_sock = connect(
-                        self.app_servers[app_env], wait_time=3, max_attempts=10
+            ins, _, _ = select.select([self.client_sock], [], [])
+            if ins:
+                msg = read_json(ins[0])
+                if msg.get("session"):
+                    ClientSession(self.manager, self.client_sock).run()
+                    return
+                # Its stdin, stdout and stderr, and for a reloadable command
+                # the socket `runserver` gets its listening socket through
+                client_fds = (
+                    recv_fds(self.client_sock, 4)
+                    if msg.get("stdio") or msg.get("reloadable")
+                    else []
+                )
+                msg["accepted"] = self.accepted
+                if Config.PROFILE:
+                    msg["timings"] = {"accepted": self.accepted}
+                try:
+                    self.manager.dispatch_command(
+                        msg, [self.client_sock.fileno()] + client_fds
                     )
-                    with closing(app_sock):
-                        write_json(msg, app_sock)
-                        redirect_map = {
-                            app_sock: self.client_sock,
-                            self.client_sock: app_sock,
-                        }
-
-                        while True:
-                            ins, _, _ = select.select(redirect_map.keys(), [], [])
-                            if not fd_redirect_list(ins, redirect_map):
-                                break
+                finally:
+                    close(client_fds)
         finally:
+            # Only close our copy, a shutdown would cut off the app server's one too
+            self.client_sock.close()
             log("DONE")
 
 
+class SessionCommand(object):
+    """
+    A command run in a `ClientSession`, along with the manager's end of the
+    socketpair that stands in for the client's socket on the app server
+    """
+
+    def __init__(self, msg, sock):
+        self.msg = msg
+        self.sock = sock
+        self.frames = FrameReader(sock)
+        self.exited = False
+
+    def quit_msg(self, sig):
+        return {
+            "command_ctl": "QUIT",
+            "signal": sig,
+            "app_env": self.msg["app_env"],
+            "client_id": self.msg["client_id"],
+        }
+
+
+class ClientSession(object):
+    """
+    A client that keeps its connection to run any number of commands over,
+    eg. an editor plugin running the tests of each file it saves
+
+    Every frame about a command carries the session id the client started it
+    with. The app server writes to a socketpair rather than to the client,
+    so that the session's commands can share its connection
+    """
+
+    def __init__(self, manager, client_sock):
+        self.manager = manager
+        self.client_sock = client_sock
+        self.frames = FrameReader(client_sock)
+        self.log = get_logger("[CLIENT_SESSION]")
+        # By session id
+        self.commands = {}
+        self.closed = False
+        self.selector = None
+
+    def _send(self, frame_type, payload, session):
+        try:
+            write_frame(self.client_sock, frame_type, payload, session)
+        except OSError:
+            # The client has gone away
+            self.closed = True
+
+    def _start_command(self, session, msg):
+        if not session or session in self.commands:
+            self.log("session %s is already in use" % session, logging.WARN)
+            self._send(EXIT, EXIT_STATUS.pack(1), session)
+            return
+        msg["accepted"] = time.time()
+        # Its output is relayed through the session, which has no listening
+        # socket to keep for `runserver` either
+        msg["stdio"] = False
+        msg["reloadable"] = False
+        sock, app_sock = socket.socketpair()
+        self.commands[session] = SessionCommand(msg, sock)
+        self.selector.register(
+            sock, selectors.EVENT_READ, functools.partial(self._relay_command, session)
+        )
+        # The app server may have to start first, which mustn't hold up the session
+        threading.Thread(target=self._dispatch, args=(msg, app_sock)).start()
+
+    def _dispatch(self, msg, app_sock):
+        try:
+            self.manager.dispatch_command(msg, [app_sock.fileno()])
+        finally:
+            # Only our copy, the app server has its own
+            app_sock.close()
+
+    def _relay_command(self, session, sock):
+        command = self.commands[session]
+        try:
+            frames = command.frames.read()
+        except OSError:
+            frames = None
+        if frames is None:
+            self.selector.unregister(sock)
+            sock.close()
+            del self.commands[session]
+            if not command.exited:
+                # The app server went away, `spring` exits with 1 then too
+                self._send(EXIT, EXIT_STATUS.pack(1), session)
+            return
+        for frame_type, _, payload in frames:
+            if frame_type == EXIT:
+                command.exited = True
+            self._send(frame_type, payload, session)
+
+    def _read_client(self, client_sock):
+        try:
+            frames = self.frames.read()
+        except OSError:
+            frames = None
+        if frames is None:
+            self.closed = True
+            return
+        for frame_type, session, payload in frames:
+            command = self.commands.get(session)
+            if frame_type != CONTROL:
+                # STDIN and RESIZE go to the command's worker as they are
+                if command:
+                    try:
+                        write_frame(command.sock, frame_type, payload)
+                    except OSError:
+                        pass
+                continue
+            msg = json.loads(payload.decode())
+            if "command" in msg:
+                self._start_command(session, msg)
+            elif msg.get("command_ctl") == "QUIT" and command:
+                self.manager.send_ctl(command.quit_msg(msg["signal"]))
+            elif msg.get("manager_ctl") == "STATUS":
+                self._send(CONTROL, json.dumps(self.manager.status()).encode(), session)
+
+    def run(self):
+        self.log("START")
+        with selectors.DefaultSelector() as self.selector:
+            self.selector.register(
+                self.client_sock, selectors.EVENT_READ, self._read_client
+            )
+            while not self.closed:
+                for key, _ in self.selector.select():
+                    key.data(key.fileobj)
+            # Nothing would read what the commands that are left write
+            for command in self.commands.values():
+                self.manager.send_ctl(command.quit_msg(signal.SIGINT))
+                command.sock.close()
+        self.log("DONE")
+
+
+class AppServerConnection(object):
+    def __init__(self):
+        self.sock = None
+        # Held while sending, so that a message and its descriptors stay together
+        self.lock = threading.Lock()
+
+
+class AppServerConnections(object):
+    """
+    One connection to each app server, that the client threads send commands
+    and control messages through rather than connecting for each of them
+
+    Messages reach the app server in the order they were sent,
+    so a command can't be overtaken by its QUIT
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # By app server socket path
+        self.connections = {}
+
+    def send(self, path, msg, fds=(), max_attempts=5, wait_time=0.2):
+        with self.lock:
+            connection = self.connections.setdefault(path, AppServerConnection())
+        with connection.lock:
+            for retry in (False, True):
+                if connection.sock is None:
+                    connection.sock = connect(path, max_attempts, wait_time)
+                    write_json({"connection": "pooled"}, connection.sock)
+                try:
+                    write_json(msg, connection.sock)
+                    if fds:
+                        send_fds(connection.sock, fds)
+                    return
+                except OSError:
+                    # The app server closed it
+                    connection.sock.close()
+                    connection.sock = None
+                    if retry:
+                        raise
+
+    def close(self, path):
+        with self.lock:
+            connection = self.connections.pop(path, None)
+        if connection:
+            with connection.lock:
+                if connection.sock:
+                    connection.sock.close()
+
+
+class AppProcess(object):
+    """
+    An app server subprocess along with the manager's end of
+    the socket it reports READY, RESTART and IDLE through
+    """
+
+    def __init__(self, app_env, path, process, ctl_sock):
+        self.app_env = app_env
+        self.path = path
+        self.process = process
+        self.ctl_sock = ctl_sock
+        self.started = time.monotonic()
+        # To compare with the mtimes of the files it imported while starting
+        self.start_time = time.time()
+        self.ready = False
+        # As of its last report
+        self.active_commands = 0
+        self.queued_commands = 0
+        # What it gave as the reason when it said it needed to RESTART
+        self.restart_reason = None
+        # Its RSS once it was ready, replacing it only helps if it grew since
+        self.ready_rss = None
+        self.over_max_rss = False
+
+    def fileno(self):
+        return self.ctl_sock.fileno()
+
+
+class EnvMetrics(object):
+    """
+    What happened to the app servers of an env, across restarts
+    """
+
+    def __init__(self):
+        self.boot_seconds = None
+        self.pool_size = None
+        self.restarts = 0
+        self.restart_reason = None
+        self.restarted = None
+        self.dispatch = Histogram()
+        self.runtime = Histogram()
+
+    def restart(self, reason):
+        self.restarts += 1
+        self.restart_reason = reason
+        self.restarted = time.time()
+
+
 class Manager(object):
     def __init__(self, path_server, path_ctl):
-        self.app_servers = multiprocessing.Manager().dict()
+        self.app_servers = {}
+        self.app_processes = {}
+        # Booting in the background to replace the app server of their env
+        self.standby_processes = {}
+        # Replaced, exiting once the commands they are running finish
+        self.retired_processes = []
+        self.draining_app_servers = {}
+        self.generations = {}
+        self.envs = load_envs()
+        # Guards `app_servers`, `in_flight` and the app processes, which
+        # `status` goes through, against the client threads. Reentrant
+        self.lock = threading.Condition()
+        # Commands being handed to the app server of each env
+        self.in_flight = {}
+        self.connections = AppServerConnections()
+        # Commands not yet handed to their app server, by client id, along
+        # with the control message their client sent in the meantime
+        self.pending_commands = {}
+        # Envs that a client is waiting on to start
+        self.start_requests = set()
+        self.start_queued = FdEvent()
+        # When each env last had a command, to stop the least recently used first
+        self.last_used = {}
+        # What the manager did about memory and idle app servers, for `status`
+        self.decisions = deque(maxlen=20)
+        self.metrics = {name: EnvMetrics() for name in self.envs}
+        self.next_memory_check = 0
         self.path_server = path_server
         self.path_ctl = path_ctl
+        self.selector = None
         self.log = get_logger("[MANAGER]")
+        # Watches the code of every app server, unless they watch their own
+        self.watcher = self._shared_watcher()
+        # Forks the app servers with django already imported, when ZYGOTE is set
+        self.zygote = None
 
-    def _start_app_server(self, app_server_id):
-        path = Config.APP_SOCK_FILE.format(app_server_id)
-        multiprocessing.Process(
-            target=self._watch, args=(app_server_id, path), daemon=True
-        ).start()
+    def _shared_watcher(self):
+        if not (Config.SHARED_WATCHER and inotify.available()):
+            return None
+        try:
+            return inotify.SharedWatcher()
+        except OSError as e:
+            self.log("Can't use inotify (%s), app servers watch their own files" % e)
+            return None
 
-    def _watch(self, app_server_id, sock_file_path):
-        def _exit_child(process, exit_signal):
-            if not process:
-                return
+    def acquire_app_server(self, app_env):
+        """
+        Called by the client threads, starts the app server of
+        `app_env` if it isn't running and waits until it has a socket
+
+        - returns the path of that socket
+        - raises KeyError if there is no such env, and AppServerUnavailable
+        if its app server exited before it could be handed the command
+        """
+        if app_env not in self.envs:
+            raise KeyError(app_env)
+        with self.lock:
+            self.in_flight[app_env] = self.in_flight.get(app_env, 0) + 1
+            self.last_used[app_env] = time.time()
+            if app_env not in self.app_servers:
+                self.start_requests.add(app_env)
+                self.start_queued.set()
+                # However busy the main loop is, it gets to the request eventually
+                self.lock.wait_for(lambda: app_env not in self.start_requests)
+            if app_env not in self.app_servers:
+                raise AppServerUnavailable(
+                    "the %s app server exited while starting" % app_env
+                )
+            return self.app_servers[app_env]
+
+    def release_app_server(self, app_env):
+        with self.lock:
+            if self.in_flight.get(app_env):
+                self.in_flight[app_env] -= 1
+
+    def dispatch_command(self, msg, fds):
+        """
+        Called by the client threads, hands the command in `msg` and the
+        client's descriptors `fds` to the app server of its env
+        """
+        app_env = msg["app_env"]
+        with self.lock:
+            self.pending_commands[msg["client_id"]] = None
+        path = None
+        try:
+            path = self.acquire_app_server(app_env)
+            # The app server talks to the client directly from here on,
+            # so none of the command's data passes through the manager. An app
+            # server that was just started binds its socket within a fraction
+            # of a second, especially when forked by the zygote
+            self.connections.send(path, msg, fds, wait_time=0.05, max_attempts=600)
+        except KeyError:
+            self._reject_command(fds, "no %s env to run the command on" % app_env)
+        except AppServerUnavailable as e:
+            self._reject_command(fds, str(e))
+        except OSError as e:
+            # Eg. it died before taking the command
+            path = None
+            self._reject_command(
+                fds, "can't hand the command to the %s app server: %s" % (app_env, e)
+            )
+        finally:
+            self.release_app_server(app_env)
+            with self.lock:
+                ctl_msg = self.pending_commands.pop(msg["client_id"])
+        if ctl_msg and path:
+            # The client was interrupted while its app server was starting
             try:
-                self.log("killing subprocess %s" % exit_signal)
-                os.kill(process.pid, exit_signal)
+                self.connections.send(path, ctl_msg)
             except OSError:
+                # It has exited, and the command with it
                 pass
-            while pid_is_alive(process.pid):
-                time.sleep(1)
-
-        def _poll_child(process):
-            exit_code = process.poll()
-            if exit_code is None:
-                time.sleep(1)
-                return process, False
-            elif exit_code != Config.RESTART_EXIT_CODE:
-                self.log("exit_code other than restart code: %s" % exit_code)
-                return None, True
+
+    def _reject_command(self, fds, reason):
+        """
+        Tells the client, whose socket is the first of `fds`,
+        why its command didn't run, and exits it with 1
+        """
+        self.log("can't run the command: %s" % reason, logging.WARN)
+        try:
+            write_frame(fds[0], STDERR, ("spring: %s\n" % reason).encode())
+            write_frame(fds[0], EXIT, EXIT_STATUS.pack(1))
+        except OSError:
+            # The client has gone away
+            pass
+
+    def send_ctl(self, msg):
+        """
+        Called by the client threads, passes on a control message (eg. QUIT)
+        to the app servers that may be running the client's command
+        """
+        with self.lock:
+            if msg["client_id"] in self.pending_commands:
+                # The command hasn't reached its app server yet, and would
+                # get there after this, `dispatch_command` sends it on instead
+                self.pending_commands[msg["client_id"]] = msg
+                return
+        with self.lock:
+            path = self.app_servers.get(msg["app_env"])
+            draining = list(self.draining_app_servers.get(msg["app_env"], []))
+        if path:
+            self.connections.send(path, msg, wait_time=1, max_attempts=5)
+        # The command may be running on an app server that has since been replaced
+        for path in draining:
+            try:
+                self.connections.send(path, msg, max_attempts=1)
+            except socket.error:
+                continue
+
+    def _start_requested_app_servers(self, start_queued):
+        start_queued.clear()
+        with self.lock:
+            for app_env in self.start_requests:
+                if app_env not in self.app_processes:
+                    self.log("starting the %s app server" % app_env, logging.WARN)
+                    self._start_app_server(app_env)
+            self.start_requests.clear()
+            self.lock.notify_all()
+
+    def _start_app_server(self, app_server_id, standby=False):
+        self.log("starting subprocess")
+        # A replacement binds a new socket while the old app server is still on its own
+        generation = self.generations.get(app_server_id, 0)
+        self.generations[app_server_id] = generation + 1
+        sock_file_path = Config.APP_SOCK_FILE.format(
+            "%s.%s" % (app_server_id, generation) if generation else app_server_id
+        )
+        app_server_path = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "app_server.py"
+        )
+        argv = [app_server_path, sock_file_path, app_server_id]
+        ctl_sock, app_ctl_sock = socket.socketpair()
+        new_environ = self.envs[app_server_id].environ(os.environ)
+        try:
+            process = None
+            if self.zygote:
+                process = self._spawn_from_zygote(argv, new_environ, app_ctl_sock)
+            if not process:
+                process = subprocess.Popen(
+                    [sys.executable]
+                    + ["-W%s" % o for o in sys.warnoptions]
+                    + argv
+                    + [str(app_ctl_sock.fileno())],
+                    env=new_environ,
+                    pass_fds=[app_ctl_sock.fileno()],
+                )
+        finally:
+            app_ctl_sock.close()
+
+        app_process = AppProcess(app_server_id, sock_file_path, process, ctl_sock)
+        self.selector.register(app_process, selectors.EVENT_READ, self._handle_app_ctl)
+        with self.lock:
+            if standby:
+                self.standby_processes[app_server_id] = app_process
             else:
-                return None, False
+                self.app_processes[app_server_id] = app_process
+                self.app_servers[app_server_id] = sock_file_path
 
-        def _spawn_child():
-            self.log("starting subprocess")
-            app_server_path = os.path.join(
-                os.path.dirname(os.path.abspath(__file__)), "app_server.py"
+    def _spawn_from_zygote(self, argv, environ, app_ctl_sock):
+        """
+        - returns the app server the zygote forked, or None if the
+        zygote is gone and the app server needs starting from scratch
+        """
+        try:
+            return self.zygote.spawn(argv, environ, app_ctl_sock)
+        except (OSError, ValueError):
+            self._zygote_lost()
+            return None
+
+    def _read_zygote(self, zygote):
+        # Eg. that it forked an app server, or one of them exited
+        if not zygote.read():
+            self._zygote_lost()
+        self._check_app_servers()
+
+    def _zygote_lost(self):
+        self.log("the zygote exited, starting app servers without it", logging.WARN)
+        self.selector.unregister(self.zygote)
+        self.zygote.close()
+        self.zygote = None
+
+    def _handle_app_ctl(self, app_process):
+        try:
+            msg = read_json(app_process.ctl_sock)
+        except ValueError:
+            # The app server has exited, `_check_app_servers` deals with that
+            self.selector.unregister(app_process)
+            return
+
+        app_server_id = app_process.app_env
+        metrics = self.metrics[app_server_id]
+        if msg["app_ctl"] in ("COMMAND_STARTED", "COMMAND_FINISHED"):
+            with self.lock:
+                app_process.active_commands = msg["active"]
+                app_process.queued_commands = msg["queued"]
+                if "dispatch" in msg:
+                    metrics.dispatch.observe(msg["dispatch"])
+                if "runtime" in msg:
+                    metrics.runtime.observe(msg["runtime"])
+        elif msg["app_ctl"] == "READY":
+            app_process.ready = True
+            app_process.ready_rss = rss(app_process.process.pid)
+            with self.lock:
+                metrics.boot_seconds = round(time.monotonic() - app_process.started, 3)
+                metrics.pool_size = msg.get("pool_size")
+            if self.standby_processes.get(app_server_id) is app_process:
+                self._swap_app_server(app_server_id)
+        elif msg["app_ctl"] == "RESTART":
+            app_process.restart_reason = msg.get("reason")
+            if (
+                msg.get("standby", True)
+                and self.app_processes.get(app_server_id) is app_process
+                and app_server_id not in self.standby_processes
+            ):
+                self.log("starting a standby %s app server" % app_server_id, logging.WARN)
+                with self.lock:
+                    metrics.restart(app_process.restart_reason)
+                self._start_app_server(app_server_id, standby=True)
+        elif msg["app_ctl"] == "WATCH":
+            self._watch_app_server_files(app_process, msg["files"], msg["globs"])
+        elif msg["app_ctl"] == "IDLE":
+            with self.lock:
+                if (
+                    self.app_processes.get(app_server_id) is app_process
+                    and app_server_id not in self.standby_processes
+                    and not self.in_flight.get(app_server_id)
+                ):
+                    self._decide("stopped the idle %s app server" % app_server_id)
+                    self._stop_app_server(app_server_id)
+
+    def _watch_app_server_files(self, app_process, files, globs):
+        if self.watcher:
+            try:
+                missed = self.watcher.register(
+                    app_process, files, globs, since=app_process.start_time
+                )
+            except OSError as e:
+                self.log(
+                    "Can't watch the files of the %s app server (%s), it watches "
+                    "them itself. To fix: raise fs.inotify.max_user_watches"
+                    % (app_process.app_env, e),
+                    logging.WARN,
+                )
+                self.watcher.unregister(app_process)
+            else:
+                if missed:
+                    self._send_files_changed(app_process, missed)
+                return
+        write_json({"app_ctl": "WATCH_UNAVAILABLE"}, app_process.ctl_sock)
+
+    def _send_files_changed(self, app_process, paths):
+        try:
+            write_json(
+                {"app_ctl": "FILES_CHANGED", "paths": sorted(paths)}, app_process.ctl_sock
             )
-            args = (
-                [sys.executable]
-                + ["-W%s" % o for o in sys.warnoptions]
-                + [app_server_path]
-                + [sock_file_path]
-                + [app_server_id]
+        except OSError:
+            # It has exited, `_check_app_servers` deals with that
+            pass
+
+    def _files_changed(self, watcher):
+        for app_process, paths in watcher.read().items():
+            self._send_files_changed(app_process, paths)
+
+    def _decide(self, decision):
+        self.log(decision, logging.WARN)
+        self.decisions.append({"time": time.time(), "decision": decision})
+
+    def _stop_app_server(self, app_server_id):
+        """
+        Retires the app server of `app_server_id`, the next command for it starts it again
+        """
+        with self.lock:
+            app_process = self.app_processes.pop(app_server_id)
+            del self.app_servers[app_server_id]
+            self._retire_app_server(app_process)
+
+    def _memory_limits(self):
+        return (
+            Config.MAX_RSS
+            or Config.MEMORY_BUDGET
+            or Config.MIN_MEM_AVAILABLE
+            or any(app_env.max_rss for app_env in self.envs.values())
+        )
+
+    def _select_timeout(self):
+        if not self._memory_limits():
+            return None
+        return max(0, self.next_memory_check - time.monotonic())
+
+    def _check_memory(self):
+        """
+        Replaces app servers that grew past their env's `max_rss`, then stops the
+        least recently used env when over MEMORY_BUDGET or MIN_MEM_AVAILABLE
+        """
+        self.next_memory_check = time.monotonic() + Config.MEMORY_CHECK_PERIOD
+        for app_server_id, app_process in list(self.app_processes.items()):
+            max_rss = self.envs[app_server_id].max_rss or Config.MAX_RSS
+            # Only the app server's own RSS, it is what grows as commands are run
+            server_rss = rss(app_process.process.pid)
+            if (
+                not max_rss
+                or not app_process.ready
+                or not server_rss
+                or server_rss <= max_rss * 1024
+                or app_server_id in self.standby_processes
+            ):
+                continue
+            if app_process.ready_rss and app_process.ready_rss > max_rss * 1024:
+                # Its replacement would be over it as well
+                if not app_process.over_max_rss:
+                    app_process.over_max_rss = True
+                    self._decide(
+                        "not replacing the %s app server, it started out over %sMB"
+                        % (app_server_id, max_rss)
+                    )
+                continue
+            reason = "its RSS of %sMB is over %sMB" % (server_rss // 1024, max_rss)
+            self._decide("replacing the %s app server, %s" % (app_server_id, reason))
+            with self.lock:
+                self.metrics[app_server_id].restart(reason)
+            self._start_app_server(app_server_id, standby=True)
+
+        # Everything each env uses, including its workers and running commands
+        used = sum(
+            tree_memory(app_process.process.pid) or 0
+            for app_process in self._all_app_processes()
+        )
+        available = mem_available()
+        if Config.MEMORY_BUDGET and used > Config.MEMORY_BUDGET * 1024:
+            pressure = "%sMB used of a %sMB budget" % (used // 1024, Config.MEMORY_BUDGET)
+        elif (
+            Config.MIN_MEM_AVAILABLE
+            and available is not None
+            and available < Config.MIN_MEM_AVAILABLE * 1024
+        ):
+            pressure = "only %sMB available" % (available // 1024)
+        else:
+            return
+
+        with self.lock:
+            candidates = [
+                app_server_id
+                for app_server_id in self.app_processes
+                if not self.envs[app_server_id].pinned
+                and not self.in_flight.get(app_server_id)
+                and app_server_id not in self.standby_processes
+            ]
+            if not candidates:
+                self._decide("%s, but every running env is pinned or busy" % pressure)
+                return
+            # One at a time, what it frees only shows once it has exited
+            app_server_id = min(candidates, key=lambda env: self.last_used.get(env, 0))
+            self._decide(
+                "%s, stopped the least recently used %s app server"
+                % (pressure, app_server_id)
             )
-            new_environ = os.environ.copy()
-            return subprocess.Popen(args, env=new_environ)
+            self._stop_app_server(app_server_id)
 
-        p = None
-        try:
-            while True:
-                if p:
-                    p, err = _poll_child(p)
-                    if err:
-                        del self.app_servers[app_server_id]
-                        return
+    def status(self):
+        """
+        Called by the client threads
+
+        - returns the state, memory and metrics of each env's
+        app server, and the recent decisions
+        """
+        envs = {}
+        with self.lock:
+            app_processes = self._all_app_processes()
+            for name, app_env in sorted(self.envs.items()):
+                metrics = self.metrics[name]
+                # Replaced app servers may still be running commands
+                env_processes = [p for p in app_processes if p.app_env == name]
+                app_process = self.app_processes.get(name)
+                if not app_process:
+                    state = "stopped"
+                elif not app_process.ready:
+                    state = "booting"
+                elif name in self.standby_processes:
+                    state = "restarting"
                 else:
-                    p = _spawn_child()
-                    self.app_servers[app_server_id] = sock_file_path
-        except KeyboardInterrupt:
+                    state = "ready"
+                pid = app_process.process.pid if app_process else None
+                envs[name] = {
+                    "state": state,
+                    "pid": pid,
+                    "pinned": app_env.pinned,
+                    "last_used": self.last_used.get(name),
+                    "draining": len(self.draining_app_servers.get(name, [])),
+                    "rss_kb": rss(pid) if pid else None,
+                    "memory_kb": tree_memory(pid) if pid else None,
+                    "max_rss_kb": (app_env.max_rss or Config.MAX_RSS) * 1024 or None,
+                    "boot_seconds": metrics.boot_seconds,
+                    "pool_size": metrics.pool_size,
+                    "active_commands": sum(p.active_commands for p in env_processes),
+                    "queued_commands": sum(p.queued_commands for p in env_processes),
+                    "restarts": metrics.restarts,
+                    "restart_reason": metrics.restart_reason,
+                    "restarted": metrics.restarted,
+                    "dispatch_seconds": metrics.dispatch.to_dict(),
+                    "command_seconds": metrics.runtime.to_dict(),
+                }
+            return {
+                "envs": envs,
+                "mem_available_kb": mem_available(),
+                "memory_budget_kb": Config.MEMORY_BUDGET * 1024 or None,
+                "decisions": list(self.decisions),
+            }
+
+    def _swap_app_server(self, app_server_id):
+        with self.lock:
+            app_process = self.standby_processes.pop(app_server_id)
+            old_app_process = self.app_processes.get(app_server_id)
+            self.app_processes[app_server_id] = app_process
+            self.app_servers[app_server_id] = app_process.path
+            if old_app_process:
+                self._retire_app_server(old_app_process)
+        self.log("switched to the standby %s app server" % app_server_id, logging.WARN)
+
+    def _retire_app_server(self, app_process):
+        with self.lock:
+            self.retired_processes.append(app_process)
+            self.draining_app_servers.setdefault(app_process.app_env, []).append(
+                app_process.path
+            )
+        if self.watcher:
+            # Changes no longer matter to it
+            self.watcher.unregister(app_process)
+        try:
+            write_json({"app_ctl": "STOP"}, app_process.ctl_sock)
+        except OSError:
             pass
-        finally:
-            _exit_child(p, signal.SIGTERM)
+
+    def _forget_app_server(self, app_process):
+        try:
+            self.selector.unregister(app_process)
+        except KeyError:
+            # Already unregistered when it closed its end
+            pass
+        app_process.ctl_sock.close()
+        self.connections.close(app_process.path)
+        if self.watcher:
+            self.watcher.unregister(app_process)
+
+    def _child_exited(self, child_exit_fd):
+        drain_fd(child_exit_fd)
+        self._check_app_servers()
+
+    def _check_app_servers(self):
+        with self.lock:
+            for app_process in list(self.retired_processes):
+                if app_process.process.poll() is None:
+                    continue
+                self.retired_processes.remove(app_process)
+                self.draining_app_servers[app_process.app_env].remove(app_process.path)
+                self._forget_app_server(app_process)
+
+            for processes, standby in (
+                (self.app_processes, False),
+                (self.standby_processes, True),
+            ):
+                for app_server_id, app_process in list(processes.items()):
+                    exit_code = app_process.process.poll()
+                    if exit_code is None:
+                        continue
+                    del processes[app_server_id]
+                    self._forget_app_server(app_process)
+                    if exit_code == Config.RESTART_EXIT_CODE:
+                        # A standby that is already booting takes over once ready
+                        if standby or app_server_id not in self.standby_processes:
+                            self.metrics[app_server_id].restart(
+                                # Otherwise it failed to set up django
+                                app_process.restart_reason
+                                or "exited with the restart code"
+                            )
+                            self._start_app_server(app_server_id, standby=standby)
+                    else:
+                        self._decide(
+                            "the %s app server exited with %s"
+                            % (app_server_id, exit_code)
+                        )
+                        if not standby:
+                            del self.app_servers[app_server_id]
+
+    def _all_app_processes(self):
+        with self.lock:
+            return (
+                list(self.app_processes.values())
+                + list(self.standby_processes.values())
+                + self.retired_processes
+            )
+
+    def _stop_app_servers(self):
+        for app_process in self._all_app_processes():
+            try:
+                self.log("killing subprocess %s" % signal.SIGTERM)
+                app_process.process.send_signal(signal.SIGTERM)
+            except OSError:
+                pass
+        for app_process in self._all_app_processes():
+            app_process.process.wait()
+
+    def _accept_data(self, manager_sock):
+        client_sock, _ = manager_sock.accept()
+        ClientToAppDataThread(manager=self, client_sock=client_sock).start()
+
+    def _accept_ctl(self, manager_ctl):
+        client_sock, _ = manager_ctl.accept()
+        ClientToAppControlThread(manager=self, client_sock=client_sock).start()
 
     def run(self):
         try:
             with bind(self.path_server) as manager_sock, bind(
                 self.path_ctl
-            ) as manager_ctl:
-                self._start_app_server("test")
-                self._start_app_server("dev")
-                manager_sock.listen(1)
-                manager_ctl.listen(1)
-                self.log("START LOOP", logging.WARN)
-
-                while True:
-                    ins, _, _ = select.select([manager_sock], [], [], 1)
-                    if ins:
-                        client_sock, _ = ins[0].accept()
-                        ClientToAppDataThread(
-                            app_servers=self.app_servers, client_sock=client_sock
-                        ).start()
-                    ins, _, _ = select.select([manager_ctl], [], [], 1)
-                    if ins:
-                        client_sock, _ = ins[0].accept()
-                        ClientToAppControlThread(
-                            app_servers=self.app_servers, client_sock=client_sock
-                        ).start()
+            ) as manager_ctl, signal_wakeup_fd(
+                signal.SIGCHLD
+            ) as child_exit_fd, selectors.DefaultSelector() as self.selector:
+                try:
+                    if Config.ZYGOTE:
+                        self.zygote = Zygote()
+                        self.selector.register(
+                            self.zygote, selectors.EVENT_READ, self._read_zygote
+                        )
+                    # The others start when a command first needs them
+                    for app_env in self.envs.values():
+                        if app_env.pinned:
+                            self._start_app_server(app_env.name)
+                    manager_sock.listen(Config.LISTEN_BACKLOG)
+                    manager_ctl.listen(Config.LISTEN_BACKLOG)
+                    self.selector.register(
+                        manager_sock, selectors.EVENT_READ, self._accept_data
+                    )
+                    self.selector.register(
+                        manager_ctl, selectors.EVENT_READ, self._accept_ctl
+                    )
+                    self.selector.register(
+                        child_exit_fd, selectors.EVENT_READ, self._child_exited
+                    )
+                    self.selector.register(
+                        self.start_queued,
+                        selectors.EVENT_READ,
+                        self._start_requested_app_servers,
+                    )
+                    if self.watcher:
+                        self.selector.register(
+                            self.watcher, selectors.EVENT_READ, self._files_changed
+                        )
+                    self.log("START LOOP", logging.WARN)
+
+                    while True:
+                        for key, _ in self.selector.select(self._select_timeout()):
+                            key.data(key.fileobj)
+                        if self._memory_limits() and (
+                            time.monotonic() >= self.next_memory_check
+                        ):
+                            self._check_memory()
+                finally:
+                    self._stop_app_servers()
+                    if self.zygote:
+                        self.zygote.close()
+                    if self.watcher:
+                        self.watcher.close()
         except KeyboardInterrupt:
             pass
         finally:
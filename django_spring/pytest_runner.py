@@ -0,0 +1,227 @@
+import importlib
+import logging
+import os
+import sys
+import time
+
+from django_spring.config import Config
+from django_spring.test_cache import cache_dir, CollectionCache, FORCE_FLAG, forced
+from django_spring.utils.logger import get_logger
+
+
+log = get_logger("[PYTEST]")
+# The top level modules of the plugins `prewarm_pytest` imported
+_preloaded_plugins = set()
+
+
+def _plugin_entry_points():
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8, the plugins are then only imported by pytest without setuptools
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return list(pkg_resources.iter_entry_points("pytest11"))
+
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        return entry_points.select(group="pytest11")
+    # Python < 3.10
+    return entry_points.get("pytest11", [])
+
+
+def prewarm_pytest():
+    """
+    Imports pytest, its builtin plugins and the installed ones (eg. pytest-django)
+    once in the app server, rather than in every `spring pytest`
+
+    - returns False if pytest isn't installed
+    """
+    try:
+        from _pytest.config import default_plugins
+    except ImportError:
+        return False
+
+    start = time.time()
+    for name in default_plugins:
+        importlib.import_module("_pytest." + name)
+    for entry_point in _plugin_entry_points():
+        try:
+            entry_point.load()
+        except Exception as e:
+            # pytest reports it when it loads the plugin itself
+            log(
+                "can't preload pytest plugin `%s`: %s" % (entry_point.name, e),
+                logging.WARN,
+            )
+            continue
+        # `module_name` for pkg_resources' entry points
+        module = getattr(entry_point, "module_name", None)
+        module = module or entry_point.value.partition(":")[0]
+        _preloaded_plugins.add(module.split(".")[0])
+    log("Preloaded pytest in %.2fs" % (time.time() - start), logging.INFO)
+    return True
+
+
+def _arg_path(config, arg):
+    # Without the tests picked from it, eg. `tests.py::test_a`
+    return os.path.abspath(os.path.join(config.invocation_params.dir, arg.split("::")[0]))
+
+
+def _collection_options(config):
+    """
+    - returns what may change what pytest collects from a test module besides
+    its code: the command line, without the tests it selects, and the ini file
+    """
+    options = []
+    args = iter(config.invocation_params.args)
+    for arg in args:
+        if arg in ("-k", "-m"):
+            next(args, None)
+        elif arg.startswith(("-k", "-m", "--keyword=", "--markexpr=")):
+            continue
+        elif not os.path.exists(_arg_path(config, arg)):
+            options.append(arg)
+    if config.inipath:
+        stat = os.stat(str(config.inipath))
+        options.append("%s:%s:%s" % (config.inipath, stat.st_mtime_ns, stat.st_size))
+    return options
+
+
+def _selection(config):
+    """
+    - returns a function telling whether `-k` and `-m` may select a test with
+    the given keywords and markers, or None when they select every test
+    """
+    from _pytest.mark.expression import Expression
+
+    keyword = config.getoption("keyword")
+    markexpr = config.getoption("markexpr")
+    if not keyword and not markexpr:
+        return None
+    try:
+        keyword = keyword and Expression.compile(keyword)
+        markexpr = markexpr and Expression.compile(markexpr)
+    except Exception:
+        # pytest reports it
+        return lambda keywords, markers: True
+
+    def selects(keywords, markers):
+        keywords = [name.lower() for name in keywords]
+
+        # Matching markers by their arguments isn't cached, so they may match
+        def keyword_matches(name, **kwargs):
+            return bool(kwargs) or any(name.lower() in k for k in keywords)
+
+        def marker_matches(name, **kwargs):
+            return bool(kwargs) or name in markers
+
+        return (not keyword or keyword.evaluate(keyword_matches)) and (
+            not markexpr or markexpr.evaluate(marker_matches)
+        )
+
+    return selects
+
+
+class CollectionCachePlugin(object):
+    """
+    Leaves out the test modules that have no test the command selects with
+    `-k` or `-m`, going by what was collected from them last time, and
+    records what is collected from the others. See `CollectionCache`
+
+    Without `-k` or `-m` every module is collected: the tests pytest runs are
+    the functions of the imported module, which only importing it gives
+    """
+
+    def __init__(self, force):
+        self.force = force
+        # Only what the app server imported, before pytest imports the conftests
+        self.cache = CollectionCache(cache_dir())
+        self.session = None
+        self.selects = None
+        # Modules only some of whose tests were asked for (eg. `tests.py::test_a`)
+        self.partial = set()
+        # path -> module name, of the modules collected in full
+        self.collected = {}
+        self.deselected = []
+        self.skipped = 0
+
+    def pytest_configure(self, config):
+        self.cache.depend_on(_collection_options(config))
+        self.selects = _selection(config)
+        self.partial = set(_arg_path(config, arg) for arg in config.args if "::" in arg)
+
+    def pytest_sessionstart(self, session):
+        self.session = session
+
+    def pytest_ignore_collect(self, collection_path, config):
+        if self.force or self.selects is None or self.session.isinitpath(collection_path):
+            return None
+        module = self.cache.module(str(collection_path))
+        tests = module and self.cache.read(module)
+        if not tests or any(self.selects(*test[1:]) for test in tests):
+            return None
+        self.skipped += 1
+        return True
+
+    def pytest_collectreport(self, report):
+        path, _, name = report.nodeid.partition("::")
+        if report.passed and not name and path.endswith(".py"):
+            path = os.path.abspath(os.path.join(str(self.session.config.rootpath), path))
+            module = self.cache.module(path)
+            if module and path not in self.partial:
+                self.collected[path] = module
+
+    def pytest_deselected(self, items):
+        self.deselected.extend(items)
+
+    def pytest_collection_finish(self, session):
+        from _pytest.mark import KeywordMatcher
+
+        tests = {}
+        # Every hook that adds markers has run by now
+        for item in session.items + self.deselected:
+            module = self.collected.get(os.path.abspath(str(item.path)))
+            if module:
+                tests.setdefault(module, []).append(
+                    [
+                        item.nodeid,
+                        sorted(KeywordMatcher.from_item(item)._names),
+                        sorted(set(marker.name for marker in item.iter_markers())),
+                    ]
+                )
+        # Modules without tests aren't recorded, eg. `--lf` collects nothing
+        # from the modules without failures
+        for module, module_tests in tests.items():
+            self.cache.write(module, module_tests)
+        self.cache.save()
+        if self.skipped:
+            sys.stderr.write(
+                "Didn't collect %s modules without tests that -k or -m select, "
+                "use %s to collect them\n" % (self.skipped, FORCE_FLAG)
+            )
+
+
+def run_pytest(args):
+    """
+    Runs pytest with the command's arguments, without FORCE_FLAG,
+    and exits with its exit status
+    """
+    import pytest
+
+    sys.argv = ["pytest"] + args
+    # Their asserts aren't rewritten, as they were imported before pytest started
+    args = [
+        "-Wignore:Module already imported so cannot be rewritten; %s:"
+        "pytest.PytestAssertRewriteWarning" % name
+        for name in sorted(_preloaded_plugins)
+    ] + args
+    plugins = []
+    if Config.COLLECTION_CACHE:
+        if hasattr(pytest, "version_tuple"):
+            plugins.append(CollectionCachePlugin(forced()))
+        else:
+            log("COLLECTION_CACHE needs pytest 7 or later", logging.WARN)
+    sys.exit(int(pytest.main(args, plugins=plugins)))
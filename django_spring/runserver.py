@@ -0,0 +1,73 @@
+import logging
+import os
+import socket
+import sys
+
+from django_spring.utils.autoreload import start_command_reloader
+from django_spring.utils.logger import get_logger
+from django_spring.utils.socket_data import read_json, recv_fds, send_fds, write_json
+
+
+log = get_logger("[RUNSERVER]")
+
+
+class _BoundSocket(socket.socket):
+    """
+    A listening socket from an earlier run, which `runserver` would bind again
+    """
+
+    def bind(self, address):
+        pass
+
+
+def use_held_socket(listen_exchange):
+    """
+    Makes `runserver` serve on the listening socket the client kept from
+    its earlier runs, which it sends over `listen_exchange`. Connections made
+    while the code reloads wait in its backlog rather than being refused.
+    On the first run, the socket `runserver` binds goes back to the client
+
+    Django's reloader is turned off. When the code the app server imported
+    changes, the client runs `runserver` again on the new app server. When
+    only code `runserver` imported since it was forked changes, it exits
+    for the client to run it again on the same app server
+    """
+    from django.core.management.commands import runserver
+
+    msg = read_json(listen_exchange)
+    held_fd = recv_fds(listen_exchange, 1)[0] if msg.get("listening") else None
+    run = runserver.Command.run
+
+    def _run(self, **options):
+        options["use_reloader"] = False
+        return run(self, **options)
+
+    runserver.Command.run = _run
+
+    def _reload(path):
+        log("%s changed, running `runserver` again" % path, logging.WARN)
+        write_json({"reload": True}, listen_exchange)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+    if not start_command_reloader(_reload):
+        log("can't watch the code `runserver` imports", logging.WARN)
+
+    server_cls = getattr(runserver.Command, "server_cls", None)
+    if server_cls is None:
+        # Older versions of Django have no way to pass another server class
+        log("can't keep the socket across reloads", logging.WARN)
+        return
+
+    class HeldSocketServer(server_cls):
+        def server_bind(self):
+            if held_fd is not None:
+                self.socket.close()
+                self.socket = _BoundSocket(fileno=held_fd)
+            super().server_bind()
+            if held_fd is None:
+                write_json({"listening": True}, listen_exchange)
+                send_fds(listen_exchange, [self.socket.fileno()])
+
+    runserver.Command.server_cls = HeldSocketServer
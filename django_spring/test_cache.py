@@ -0,0 +1,421 @@
+import ast
+import hashlib
+import json
+import os
+import sys
+import unittest
+
+from django_spring.config import Config
+from django_spring.utils.logger import get_logger
+from django_spring.utils.module_index import module_index
+
+
+log = get_logger("[TEST_CACHE]")
+ROOT_DIR = os.getcwd()
+# Runs every requested test, even those the cache would skip
+FORCE_FLAG = "--spring-force"
+
+_force = False
+
+
+def pop_force_flag(args):
+    """
+    Django doesn't know FORCE_FLAG, so it's taken out of the command's arguments
+
+    - returns `args` without it
+    """
+    global _force
+    _force = FORCE_FLAG in args
+    return [arg for arg in args if arg != FORCE_FLAG]
+
+
+def forced():
+    """
+    - returns whether `pop_force_flag` found FORCE_FLAG in the command
+    """
+    return _force
+
+
+def cache_dir():
+    key = hashlib.md5(ROOT_DIR.encode()).hexdigest()[:12]
+    return os.path.join(Config.TEST_CACHE_DIR, key)
+
+
+def _read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%s" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    # Commands running at the same time may write the same file
+    os.replace(tmp_path, path)
+
+
+def _resolve(name, level, package):
+    """
+    - returns the absolute name of a `from ... import` with the given `level`
+    """
+    if not level:
+        return name
+    parts = package.split(".") if package else []
+    if level > 1:
+        parts = parts[: -(level - 1)]
+    return ".".join(parts + ([name] if name else []))
+
+
+def _with_parents(name):
+    # Importing a module runs its packages' `__init__` first
+    parts = name.split(".")
+    return [".".join(parts[: i + 1]) for i in range(len(parts))]
+
+
+class ImportGraph(object):
+    """
+    What the project's modules import, read from their source rather than
+    by importing them, so the dependencies of a test module are known
+    before it runs
+
+    The imports found in each file are cached by the file's mtime and size
+    """
+
+    def __init__(self, files, path):
+        # module name -> source file, for the project's modules only
+        self.files = files
+        self.path = path
+        # source file -> [mtime, size, imported names]
+        self.imports = _read_json(path, {})
+        self._changed = False
+
+    def save(self):
+        if self._changed:
+            # Files that no longer exist are dropped
+            paths = set(self.files.values())
+            _write_json(
+                self.path, {p: v for p, v in self.imports.items() if p in paths}
+            )
+
+    def _imports_of(self, name, path, stat):
+        cached = self.imports.get(path)
+        if cached and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return cached[2]
+        try:
+            with open(path, "rb") as f:
+                tree = ast.parse(f.read(), path)
+        except (OSError, SyntaxError, ValueError):
+            # Its test will fail to import and never be cached
+            return []
+        is_package = os.path.basename(path) == "__init__.py"
+        package = name if is_package else name.rpartition(".")[0]
+        names = set()
+        # Imports inside functions count too, the code they run may be tested
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                base = _resolve(node.module, node.level, package)
+                if base:
+                    names.add(base)
+                # Names imported from a package may be its submodules
+                names.update(
+                    base + "." + alias.name if base else alias.name
+                    for alias in node.names
+                    if alias.name != "*"
+                )
+        names = sorted(names)
+        self.imports[path] = [stat.st_mtime_ns, stat.st_size, names]
+        self._changed = True
+        return names
+
+    def fingerprint(self, names):
+        """
+        - returns a hash of the source files of the project modules in `names`
+        and of everything they import, which changes when any of them does
+        """
+        seen = set()
+        stats = []
+        stack = [parent for name in names for parent in _with_parents(name)]
+        while stack:
+            name = stack.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            path = self.files.get(name)
+            if not path:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats.append("%s:%s:%s" % (path, stat.st_mtime_ns, stat.st_size))
+            for imported in self._imports_of(name, path, stat):
+                stack.extend(_with_parents(imported))
+        return hashlib.sha1("\n".join(sorted(stats)).encode()).hexdigest()
+
+
+class ModuleCache(object):
+    """
+    Something known about each test module, kept in a file per module under
+    `path`, that stays valid until the code it depends on changes: neither
+    the module, the project modules it imports (recursively), nor the
+    project modules the app server imported changed since
+    """
+
+    # The directory of the module files under `path`
+    kind = None
+
+    def __init__(self, path):
+        self.path = path
+        index = module_index(ROOT_DIR)
+        # Picks up modules added since the app server started
+        index.update()
+        self.graph = ImportGraph(index.files(), os.path.join(path, "imports.json"))
+        # Everything was imported by the app server, and changing any of
+        # it may change what every test does
+        self.base = self.graph.fingerprint(
+            name for name in list(sys.modules) if name in self.graph.files
+        )
+        self._keys = {}
+
+    def _module_path(self, module):
+        return os.path.join(self.path, self.kind, module + ".json")
+
+    def key(self, module):
+        if module not in self._keys:
+            if module in self.graph.files:
+                self._keys[module] = self.base + self.graph.fingerprint([module])
+            else:
+                # Not a source file of the project, nothing is known about it
+                self._keys[module] = None
+        return self._keys[module]
+
+    def read(self, module):
+        """
+        - returns what was written for `module` with the code as it is, or None
+        """
+        key = self.key(module)
+        if key is None:
+            return None
+        path = self._module_path(module)
+        record = _read_json(path, {})
+        if record.get("key") != key:
+            return None
+        # Marks it as recently used for `evict`
+        os.utime(path)
+        return record.get("value")
+
+    def write(self, module, value):
+        key = self.key(module)
+        if key is not None:
+            _write_json(self._module_path(module), {"key": key, "value": value})
+
+    def save(self):
+        self.graph.save()
+        # Shared by every project's cache
+        evict(Config.TEST_CACHE_DIR, Config.TEST_CACHE_MAX_SIZE * 1024 * 1024)
+
+
+class TestCache(ModuleCache):
+    """
+    Which tests passed and what the code they ran looked like then
+
+    A test is skipped when it passed last time and the code it
+    depends on didn't change since, see `ModuleCache`
+    """
+
+    kind = "tests"
+
+    def passed(self, module):
+        """
+        - returns the ids of the tests of `module` that passed with the code as it is
+        """
+        return set(self.read(module) or [])
+
+    def record(self, module, passed, failed):
+        passed = (self.passed(module) | passed) - failed
+        self.write(module, sorted(passed))
+
+
+class CollectionCache(ModuleCache):
+    """
+    What pytest collected from each test module: the id, keywords and markers
+    of each of its tests, so that a module with none that `-k` or `-m` select
+    needn't be imported to find out
+
+    Besides the code of the module, see `ModuleCache`, the records depend on
+    the project's conftests and on what `depend_on` is given
+    """
+
+    kind = "collected"
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.modules = {path: name for name, path in self.graph.files.items()}
+        conftests = [
+            name for name in self.graph.files if name.rpartition(".")[2] == "conftest"
+        ]
+        self.base += self.graph.fingerprint(conftests)
+
+    def depend_on(self, options):
+        """
+        Makes the records depend on `options` too, eg. the command line,
+        must be called before any is read or written
+        """
+        options = json.dumps(options, sort_keys=True).encode()
+        self.base += hashlib.sha1(options).hexdigest()
+
+    def module(self, path):
+        """
+        - returns the name of the project module whose source is `path`, or None
+        """
+        return self.modules.get(os.path.abspath(path))
+
+
+def evict(path, max_size):
+    """
+    Removes the least recently used files under `path`
+    until they take no more than `max_size` bytes
+    """
+    files = []
+    for directory, _, names in os.walk(path):
+        for name in names:
+            file_path = os.path.join(directory, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file_path))
+    total = sum(size for _, size, _ in files)
+    for _, size, file_path in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.remove(file_path)
+        except OSError:
+            continue
+        total -= size
+    log("%s bytes cached in %s" % (total, path))
+
+
+def _iter_tests(suite):
+    # A `ParallelTestSuite` keeps its tests in `subsuites`
+    for test in getattr(suite, "subsuites", suite):
+        if isinstance(test, unittest.TestSuite):
+            yield from _iter_tests(test)
+        else:
+            yield test
+
+
+def _filter_suite(suite, keep):
+    """
+    - returns `suite` without the tests `keep` returns False for,
+    and without the suites that are then empty
+    """
+    if hasattr(suite, "subsuites"):
+        suite.subsuites = [_filter_suite(subsuite, keep) for subsuite in suite.subsuites]
+        suite.subsuites = [s for s in suite.subsuites if s.countTestCases()]
+        return suite
+    tests = []
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            test = _filter_suite(test, keep)
+            if test.countTestCases():
+                tests.append(test)
+        elif keep(test):
+            tests.append(test)
+    return suite.__class__(tests)
+
+
+def _cacheable(test):
+    # Not the placeholders for modules that failed to import
+    return isinstance(test, unittest.TestCase) and not isinstance(
+        test, unittest.loader._FailedTest
+    )
+
+
+def _skip_unchanged(suite, cache):
+    passed = {}
+    skipped = []
+
+    def keep(test):
+        if not _cacheable(test):
+            return True
+        module = type(test).__module__
+        if module not in passed:
+            passed[module] = cache.passed(module)
+        if test.id() in passed[module]:
+            skipped.append(test.id())
+            return False
+        return True
+
+    suite = _filter_suite(suite, keep)
+    if skipped:
+        sys.stderr.write(
+            "Skipped %s tests that passed last time and whose code hasn't changed, "
+            "use %s to run them\n" % (len(skipped), FORCE_FLAG)
+        )
+    return suite
+
+
+def _tests_by_module(suite):
+    by_module = {}
+    for test in _iter_tests(suite):
+        if _cacheable(test):
+            by_module.setdefault(type(test).__module__, []).append(test.id())
+    return by_module
+
+
+def _record_outcomes(by_module, result, cache):
+    failed = set()
+    for test, _ in result.failures + result.errors:
+        # Failed subtests fail the test they're part of
+        failed.add(getattr(test, "test_case", test).id())
+    failed.update(test.id() for test in result.unexpectedSuccesses)
+    skipped = set(test.id() for test, _ in result.skipped)
+
+    if result.shouldStop:
+        # Interrupted, or stopped at the first failure: the tests that didn't
+        # run are in the suite but not in the result
+        ran = failed | skipped
+        by_module = {m: [i for i in ids if i in ran] for m, ids in by_module.items()}
+    for module, ids in by_module.items():
+        ids = set(ids)
+        cache.record(module, ids - failed - skipped, ids & failed)
+    cache.save()
+
+
+def use_test_cache():
+    """
+    Makes `spring test` skip the tests that passed last time and whose
+    dependencies haven't changed since, see `TestCache`
+    """
+    from django.test.runner import DiscoverRunner
+
+    build_suite = DiscoverRunner.build_suite
+    run_suite = DiscoverRunner.run_suite
+
+    def _build_suite(self, *args, **kwargs):
+        # Only what the app server imported, before the test modules are
+        self._spring_cache = TestCache(cache_dir())
+        suite = build_suite(self, *args, **kwargs)
+        if _force:
+            return suite
+        return _skip_unchanged(suite, self._spring_cache)
+
+    def _run_suite(self, suite, **kwargs):
+        cache = getattr(self, "_spring_cache", None)
+        # Suites let go of their tests as they run them
+        by_module = _tests_by_module(suite) if cache else None
+        result = run_suite(self, suite, **kwargs)
+        if cache:
+            _record_outcomes(by_module, result, cache)
+        return result
+
+    DiscoverRunner.build_suite = _build_suite
+    DiscoverRunner.run_suite = _run_suite
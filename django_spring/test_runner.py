@@ -0,0 +1,315 @@
+import logging
+import multiprocessing
+import os
+import pickle
+import select
+import signal
+import socket
+import struct
+import traceback
+from collections import deque
+
+from django_spring.utils.logger import get_logger
+
+
+log = get_logger("[TEST_RUNNER]")
+
+
+def prewarm_test_runner():
+    """
+    Does the command independent parts of the test runner's setup once in
+    the app server so that every forked command inherits the result:
+    - imports the test runner class
+    - loads the migration graph and verifies the kept test databases
+    - runs the system checks
+
+    Database connections can't be shared with forked children,
+    so they are all closed again before returning
+    """
+    from django.conf import settings
+    from django.db import connections
+    from django.test.utils import get_runner
+
+    log("Starting `prewarm_test_runner`")
+    runner_class = get_runner(settings)
+    try:
+        _verify_test_databases()
+        _run_checks(runner_class)
+    finally:
+        connections.close_all()
+    log("Done `prewarm_test_runner`")
+
+
+def _verify_test_databases():
+    from django.db import connections, DatabaseError
+    from django.db.migrations.loader import MigrationLoader
+
+    # Imports every migration module, which is most of the cost of `migrate`
+    loader = MigrationLoader(None, ignore_no_migrations=True)
+    leaf_nodes = set(loader.graph.leaf_nodes())
+
+    for alias in connections:
+        connection = connections[alias]
+        test_db_name = connection.creation._get_test_db_name()
+        if connection.vendor == "sqlite":
+            if connection.creation.is_in_memory_db(test_db_name):
+                continue
+            if not os.path.exists(test_db_name):
+                log("test database for alias '%s' doesn't exist yet" % alias)
+                continue
+
+        test_connection = connection.__class__(
+            dict(connection.settings_dict, NAME=test_db_name), alias
+        )
+        try:
+            applied = _applied_migrations(test_connection)
+        except DatabaseError as e:
+            log("can't verify test database for alias '%s': %s" % (alias, e))
+            continue
+        finally:
+            test_connection.close()
+
+        unapplied = leaf_nodes.difference(applied)
+        if unapplied:
+            log(
+                "test database for alias '%s' is missing migrations: %s"
+                % (alias, ", ".join("%s.%s" % key for key in sorted(unapplied))),
+                logging.WARN,
+            )
+
+
+def _applied_migrations(connection):
+    from django.db.migrations.recorder import MigrationRecorder
+
+    # `MigrationRecorder` queries through the alias, which points
+    # at the regular database rather than the test one
+    table = MigrationRecorder.Migration._meta.db_table
+    with connection.cursor() as cursor:
+        if table not in connection.introspection.table_names(cursor):
+            return set()
+        cursor.execute(
+            "SELECT app, name FROM %s" % connection.ops.quote_name(table)
+        )
+        return set(cursor.fetchall())
+
+
+def _run_checks(runner_class):
+    from django.core import checks
+
+    issues = checks.run_checks(include_deployment_checks=False)
+    if any(issue.is_serious() and not issue.is_silenced() for issue in issues):
+        log("system checks failed, commands will run them again", logging.WARN)
+        return
+    # Only the checks that need the test databases are left for the command
+    runner_class.run_checks = _run_database_checks
+
+
+def _run_database_checks(runner, databases=None):
+    from django.core.checks import Tags
+    from django.core.management import call_command
+
+    kwargs = {"databases": databases} if databases is not None else {}
+    call_command("check", tags=[Tags.database], verbosity=runner.verbosity, **kwargs)
+
+
+def use_forked_test_workers():
+    """
+    Makes `test --parallel` run its workers with `ForkPool`
+    """
+    from django.test.runner import DiscoverRunner, ParallelTestSuite
+
+    class SpringParallelTestSuite(ParallelTestSuite):
+        def run(self, result):
+            pool_class = multiprocessing.Pool
+            multiprocessing.Pool = ForkPool
+            try:
+                return super().run(result)
+            finally:
+                multiprocessing.Pool = pool_class
+
+    DiscoverRunner.parallel_test_suite = SpringParallelTestSuite
+
+
+_HEADER = struct.Struct("!I")
+
+
+def _send(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def _recv(sock):
+    (size,) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+class _StreamedEvents(list):
+    """
+    Sends the events of a `RemoteTestResult` to the parent as each test
+    finishes, so that the output of tests running at the same time
+    doesn't get interleaved
+    """
+
+    def __init__(self, sock, subsuite_index):
+        super().__init__()
+        self.sock = sock
+        self.subsuite_index = subsuite_index
+
+    def append(self, event):
+        super().append(event)
+        if event[0] in ("stopTest", "stopTestRun"):
+            self.flush()
+
+    def flush(self):
+        if self:
+            _send(self.sock, ("events", self.subsuite_index, list(self)))
+            del self[:]
+
+
+def _streaming_runner_class(runner_class, sock, subsuite_index):
+    class StreamingResult(runner_class.resultclass):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.events = _StreamedEvents(sock, subsuite_index)
+
+    class StreamingRunner(runner_class):
+        resultclass = StreamingResult
+
+        def run(self, test):
+            result = super().run(test)
+            # Errors in class and module fixtures aren't followed by a `stopTest`
+            result.events.flush()
+            return result
+
+    return StreamingRunner
+
+
+class ForkPool(object):
+    """
+    Just enough of `multiprocessing.Pool` for `ParallelTestSuite.run`
+
+    The workers are forked straight from the command once the tasks are
+    known, so they start warm with the tasks already in memory and only
+    task indexes are sent to them. Test events are streamed back as each
+    test finishes instead of once a whole subsuite has
+    """
+
+    def __init__(self, processes, initializer=None, initargs=()):
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        # sock -> pid
+        self.workers = {}
+
+    def _fork(self, func, tasks):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                close_socks = [parent_sock] + list(self.workers)
+                for sock in close_socks:
+                    sock.close()
+                self._worker(child_sock, func, tasks)
+            except BaseException:
+                exit_code = 1
+                try:
+                    _send(child_sock, ("error", traceback.format_exc()))
+                except OSError:
+                    pass
+            finally:
+                os._exit(exit_code)
+        child_sock.close()
+        self.workers[parent_sock] = pid
+        return parent_sock
+
+    def _worker(self, sock, func, tasks):
+        if self.initializer:
+            self.initializer(*self.initargs)
+        while True:
+            index = _recv(sock)
+            if index is None:
+                return
+            args = tasks[index]
+            runner_class = _streaming_runner_class(args[0], sock, index)
+            func((runner_class,) + tuple(args[1:]))
+            _send(sock, ("done", index))
+
+    def imap_unordered(self, func, iterable):
+        tasks = list(iterable)
+        results = _ForkPoolResults(self, tasks)
+        for _ in range(min(self.processes, len(tasks))):
+            results.assign(self._fork(func, tasks))
+        return results
+
+    def terminate(self):
+        for pid in self.workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def close(self):
+        for sock in self.workers:
+            sock.close()
+
+    def join(self):
+        for pid in self.workers.values():
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.workers = {}
+
+
+class _ForkPoolResults(object):
+    def __init__(self, pool, tasks):
+        self.pool = pool
+        self.pending = deque(range(len(tasks)))
+        self.remaining = len(tasks)
+        self.ready = deque()
+        self.idle = []
+
+    def assign(self, sock):
+        if self.pending:
+            _send(sock, self.pending.popleft())
+        else:
+            _send(sock, None)
+            self.idle.append(sock)
+
+    def next(self, timeout=None):
+        while not self.ready:
+            if not self.remaining:
+                raise StopIteration
+            busy = [sock for sock in self.pool.workers if sock not in self.idle]
+            socks, _, _ = select.select(busy, [], [], timeout)
+            if not socks:
+                raise multiprocessing.TimeoutError
+            for sock in socks:
+                self._handle(sock)
+        return self.ready.popleft()
+
+    def _handle(self, sock):
+        try:
+            message = _recv(sock)
+        except EOFError:
+            raise RuntimeError(
+                "test worker %s exited unexpectedly" % self.pool.workers[sock]
+            )
+        if message[0] == "events":
+            self.ready.append(message[1:])
+        elif message[0] == "done":
+            self.remaining -= 1
+            self.assign(sock)
+        elif message[0] == "error":
+            raise RuntimeError("test worker failed:\n%s" % message[1])
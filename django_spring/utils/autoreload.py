@@ -1,10 +1,14 @@
+import functools
 import logging
 import os
 import time
 import threading
+from contextlib import closing
+from pathlib import Path
 
 from django_spring.app_setup import setup_django
 from django_spring.config import Config
+from django_spring.utils import inotify
 from django_spring.utils.logger import get_logger
 from django_spring.utils.preload import preload_views
 
@@ -20,6 +24,9 @@ def _run_django_code_changed_reloader(log):
     if USE_INOTIFY:
         preload_views()
         fn = inotify_code_changed
+    elif inotify.available():
+        preload_views()
+        fn = functools.partial(_inotify_code_changed, FILE_MODIFIED)
     else:
         log(
             "Using stat reloader which is CPU intensive. To fix: `pip install pyinotify`",
@@ -29,12 +36,111 @@ def _run_django_code_changed_reloader(log):
     while True:
         change = fn()
         if change == FILE_MODIFIED:
-            return True
+            return "code changed"
         else:
             time.sleep(Config.CODE_RELOADER_POLL_PERIOD)
 
 
-def _get_reloader(log):
+def _inotify_code_changed(file_modified):
+    """
+    Like django's `inotify_code_changed`, without needing pyinotify
+    """
+    from django.utils.autoreload import gen_filenames
+
+    with closing(inotify.FileWatcher()) as watcher:
+        while True:
+            files = set(os.path.abspath(f) for f in gen_filenames())
+            watcher.watch(set(os.path.dirname(f) for f in files))
+            changed = watcher.read()
+            if changed is None or changed & files:
+                return file_modified
+
+
+def _inotify_tick(reloader, log):
+    """
+    Like `StatReloader.tick`, but sleeps until inotify reports a change in the
+    directories of the watched files rather than stat'ing all of them every
+    SLEEP_TIME. Only files whose mtime changed, or that were added or removed,
+    are notified
+    """
+    from django.utils.autoreload import StatReloader
+
+    try:
+        watcher = inotify.FileWatcher()
+    except OSError as e:
+        log("Can't use inotify (%s), using the stat reloader" % e, logging.WARN)
+        yield from StatReloader.tick(reloader)
+        return
+
+    with closing(watcher):
+        mtimes = dict(reloader.snapshot_files())
+        while True:
+            try:
+                watcher.watch(
+                    set(path.parent for path in mtimes),
+                    recursive=[
+                        directory
+                        for directory, patterns in reloader.directory_globs.items()
+                        if any("**" in pattern for pattern in patterns)
+                    ],
+                )
+            except OSError as e:
+                log(
+                    "Can't watch every directory (%s), using the stat reloader. "
+                    "To fix: raise fs.inotify.max_user_watches" % e,
+                    logging.WARN,
+                )
+                yield from StatReloader.tick(reloader)
+                return
+            changed = watcher.read()
+            previous, mtimes = mtimes, dict(reloader.snapshot_files())
+            if changed is None:
+                log("Missed file changes, checking every watched file", logging.WARN)
+                changed = previous.keys() | mtimes.keys()
+            else:
+                changed = set(Path(path) for path in changed)
+            for path in sorted(changed):
+                if mtimes.get(path) != previous.get(path):
+                    reloader.notify_file_changed(path)
+                    if reloader.should_stop:
+                        break
+            yield
+
+
+def _needs_restart(reloader, path, log):
+    """
+    Only what the app server imported itself is stale in the commands it forks,
+    anything else is read again by each command
+
+    - returns whether the app server has to restart to pick up the change
+    """
+    from django.utils.autoreload import file_changed, iter_all_python_module_files
+
+    # Templates and translations are handled by django resetting their caches
+    results = file_changed.send(sender=reloader, file_path=path)
+    if any(res[1] for res in results):
+        log("%s changed, reset its caches" % path)
+        return False
+    if path.suffix == ".py" and path not in iter_all_python_module_files():
+        log("%s changed, it isn't imported by the app server" % path)
+        return False
+    return True
+
+
+def _notify_file_changed(reloader, path, recycle_queued, log):
+    if Config.SELECTIVE_RELOAD and not _needs_restart(reloader, path, log):
+        # Idle workers were forked before the change
+        recycle_queued.set()
+        return
+    reloader.changed_path = path
+    reloader.stop()
+
+
+def _get_reloader(log, on_change):
+    """
+    - returns a django reloader that calls `on_change` with itself
+    and the path of every file that changes
+    """
     from django.utils.autoreload import (
         StatReloader,
         WatchmanReloader,
@@ -46,54 +152,176 @@ def _get_reloader(log):
 
         class WatchmanReloaderWithQueuedRestart(WatchmanReloader):
             def notify_file_changed(self, path):
-                self.stop()
+                on_change(self, path)
 
         return WatchmanReloaderWithQueuedRestart()
     except WatchmanUnavailable:
-        log(
-            "Using stat reloader which is CPU intensive. To fix: Install Watchman and `pip install pywatchman`",
-            logging.WARN,
-        )
+        pass
 
-        class StatReloaderWithQueuedRestart(StatReloader):
+    if inotify.available():
+
+        class InotifyReloaderWithQueuedRestart(StatReloader):
             SLEEP_TIME = Config.CODE_RELOADER_POLL_PERIOD
 
+            def tick(self):
+                return _inotify_tick(self, log)
+
             def notify_file_changed(self, path):
-                self.stop()
+                on_change(self, path)
+
+        return InotifyReloaderWithQueuedRestart()
 
-        return StatReloaderWithQueuedRestart()
+    log(
+        "Using stat reloader which is CPU intensive. To fix: Install Watchman and `pip install pywatchman`",
+        logging.WARN,
+    )
 
+    class StatReloaderWithQueuedRestart(StatReloader):
+        SLEEP_TIME = Config.CODE_RELOADER_POLL_PERIOD
 
-def _run_django_reloader(log):
-    _get_reloader(log).run_loop()
-    return True
+        def notify_file_changed(self, path):
+            on_change(self, path)
+
+    return StatReloaderWithQueuedRestart()
 
 
-def _run_reloader(restart_queued):
+def _run_django_reloader(log, recycle_queued):
+    from django.utils.autoreload import autoreload_started
+
+    reloader = _get_reloader(
+        log,
+        functools.partial(_notify_file_changed, recycle_queued=recycle_queued, log=log),
+    )
+    if Config.SELECTIVE_RELOAD:
+        # Lets django add the template and locale directories to the watched files
+        autoreload_started.send(sender=reloader)
+    reloader.run_loop()
+    # `run_loop` only returns once `stop` was called for a change
+    return "%s changed" % getattr(reloader, "changed_path", "code")
+
+
+def _run_reloader(restart_queued, recycle_queued):
     log = get_logger("[CODE_WATCHER]")
     try:
         # Django >= 2.2
-        should_reload = _run_django_reloader(log)
+        reason = _run_django_reloader(log, recycle_queued)
     except ImportError:
-        should_reload = _run_django_code_changed_reloader(log)
-    if should_reload:
-        log("Restart Queued", logging.WARN)
-        restart_queued.set()
+        reason = _run_django_code_changed_reloader(log)
+    if reason:
+        log("Restart Queued: %s" % reason, logging.WARN)
+        restart_queued.set(reason)
+
+
+def watched_paths():
+    """
+    For the manager's watcher, which watches the files of every app server
+
+    - returns the files this app server's reloader would watch, and the
+    directory globs (eg. of templates) that new files are matched against
+    """
+    from django.utils.autoreload import autoreload_started, BaseReloader
 
+    reloader = BaseReloader()
+    if Config.SELECTIVE_RELOAD:
+        autoreload_started.send(sender=reloader)
+    files = sorted(set(str(path) for path in reloader.watched_files()))
+    globs = {
+        str(directory): sorted(patterns)
+        for directory, patterns in reloader.directory_globs.items()
+    }
+    return files, globs
 
-def reloader_thread(restart_queued, app_env):
+
+def files_changed(paths, restart_queued, recycle_queued):
+    """
+    Called with the files the manager's watcher saw change, queues a restart
+    or replaces the idle workers like the app server's own reloader would
+    """
+    if restart_queued.is_set():
+        # Like the reloader thread, which stops once it queued one
+        return
+    log = get_logger("[CODE_WATCHER]")
+    for path in map(Path, paths):
+        if Config.SELECTIVE_RELOAD and not _needs_restart(None, path, log):
+            recycle_queued.set()
+            continue
+        reason = "%s changed" % path
+        log("Restart Queued: %s" % reason, logging.WARN)
+        restart_queued.set(reason)
+        return
+
+
+def reloader_thread(restart_queued, recycle_queued, app_env, setup=True):
     try:
-        setup_django(app_env)
-        _run_reloader(restart_queued)
+        if setup:
+            setup_django(app_env)
+        _run_reloader(restart_queued, recycle_queued)
     except KeyboardInterrupt:
         pass
 
 
-def python_reloader(main_func, restart_queued, app_env, *args, **kwargs):
+def start_reloader(restart_queued, recycle_queued, app_env, setup=True):
+    """
+    Watches the code in a thread of its own, which queues a restart when it changes.
+    Without `setup`, django must already be set up
+    """
+    threading.Thread(
+        target=reloader_thread, args=[restart_queued, recycle_queued, app_env, setup]
+    ).start()
+
+
+def _run_command_reloader(inherited, on_change):
+    from django.utils.autoreload import autoreload_started
+
+    log = get_logger("[CODE_WATCHER]")
+
+    def _changed(reloader, path):
+        # The app server restarts for what it imported itself
+        if path not in inherited and _needs_restart(reloader, path, log):
+            reloader.changed_path = path
+            reloader.stop()
+
+    reloader = _get_reloader(log, _changed)
+    autoreload_started.send(sender=reloader)
+    reloader.run_loop()
+    on_change(reloader.changed_path)
+
+
+def start_command_reloader(on_change):
+    """
+    Watches the code a long running command (eg. `runserver`) imports after it
+    was forked, which the app server doesn't watch, in a thread that calls
+    `on_change` with the first file of it that changes. Template and
+    translation changes just reset their caches
+
+    - returns False if django is too old to watch the code with
+    """
+    try:
+        from django.utils.autoreload import iter_all_python_module_files
+    except ImportError:
+        return False
+    threading.Thread(
+        target=_run_command_reloader,
+        args=[set(iter_all_python_module_files()), on_change],
+        daemon=True,
+    ).start()
+    return True
+
+
+def python_reloader(
+    main_func, restart_queued, recycle_queued, app_env, *args, watch=True, **kwargs
+):
+    """
+    Runs `main_func`, with a reloader thread unless not `watch`
+    (eg. when the manager watches the code)
+    """
     try:
-        threading.Thread(target=reloader_thread, args=[restart_queued, app_env]).start()
+        if watch:
+            start_reloader(restart_queued, recycle_queued, app_env)
         main_func(*args, **kwargs)
     except KeyboardInterrupt:
         pass
     if restart_queued.is_set():
         os._exit(Config.RESTART_EXIT_CODE)
+    # The reloader thread only returns once it has queued a restart
+    os._exit(0)
@@ -0,0 +1,383 @@
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import select
+import struct
+import sys
+import time
+
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+# inotify_init1 takes the open(2) flags
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# wd, mask, cookie and the length of the name that follows
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return _libc
+
+
+def available():
+    """
+    - returns whether inotify can be used here
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        return hasattr(_get_libc(), "inotify_init1")
+    except OSError:
+        return False
+
+
+def _check(result, path=None):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    return result
+
+
+class Inotify(object):
+    """
+    The inotify(7) syscalls, through ctypes so that nothing needs installing
+    """
+
+    def __init__(self):
+        self.fd = _check(_get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        # A directory watched under several paths (eg. through a symlink) has one wd
+        self.paths = {}
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path, mask):
+        """
+        - returns the watch descriptor, or None if `path` can't be watched
+        (eg. it was removed since it was listed)
+        """
+        try:
+            wd = _check(
+                _get_libc().inotify_add_watch(self.fd, os.fsencode(path), mask), path
+            )
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return None
+            # ENOSPC means fs.inotify.max_user_watches is reached
+            raise
+        self.paths.setdefault(wd, set()).add(path)
+        return wd
+
+    def rm_watch(self, wd, path):
+        """
+        Stops watching `path`, and the directory it is watched under
+        once it isn't watched under any other path
+        """
+        paths = self.paths.get(wd, set())
+        paths.discard(path)
+        if paths:
+            return
+        self.paths.pop(wd, None)
+        try:
+            _check(_get_libc().inotify_rm_watch(self.fd, wd), path)
+        except OSError:
+            # Already removed along with its directory
+            pass
+
+    def read(self):
+        """
+        - returns the path and mask of every event that is waiting, the path
+        is None for IN_Q_OVERFLOW
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                elif mask & IN_IGNORED:
+                    # Its directory was removed
+                    self.paths.pop(wd, None)
+                else:
+                    for path in self.paths.get(wd, ()):
+                        events.append((os.path.join(path, name) if name else path, mask))
+
+
+class FileWatcher(object):
+    """
+    Watches directories for changes to the files in them, and below the
+    `recursive` ones for changes anywhere, including in directories
+    created later on
+
+    Waiting costs nothing until something changes, unlike stat'ing
+    every file again and again
+    """
+
+    MASK = (
+        IN_ATTRIB
+        | IN_CLOSE_WRITE
+        | IN_CREATE
+        | IN_DELETE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_ONLYDIR
+    )
+    # Editors save in several steps (eg. write a temporary file then
+    # rename it), they are reported once they settle
+    DEBOUNCE_TIME = 0.05
+    # But a long burst (eg. `git checkout`) is reported in parts,
+    # rather than keeping whoever reads waiting until it ends
+    MAX_DEBOUNCE_TIME = 0.5
+
+    def __init__(self):
+        self.inotify = Inotify()
+        # directory -> its watch descriptor
+        self.watched = {}
+        self.recursive = set()
+
+    def fileno(self):
+        return self.inotify.fileno()
+
+    def close(self):
+        self.inotify.close()
+
+    def _add(self, directory):
+        if directory not in self.watched:
+            wd = self.inotify.add_watch(directory, self.MASK)
+            if wd is not None:
+                self.watched[directory] = wd
+
+    def _add_tree(self, root):
+        for directory, dirs, _ in os.walk(root):
+            dirs[:] = [d for d in dirs if not d.startswith(".") and d != "__pycache__"]
+            self._add(directory)
+
+    def watch(self, directories, recursive=()):
+        """
+        Adds watches for the `directories`, and the trees under `recursive`,
+        that aren't watched yet
+        """
+        for directory in directories:
+            self._add(str(directory))
+        for root in recursive:
+            root = str(root)
+            if root not in self.recursive:
+                self.recursive.add(root)
+                self._add_tree(root)
+
+    def keep(self, directories, recursive=()):
+        """
+        Removes the watches of every directory but the `directories`,
+        and the trees under `recursive`
+        """
+        directories = set(str(directory) for directory in directories)
+        self.recursive &= set(str(root) for root in recursive)
+        for directory, wd in list(self.watched.items()):
+            if directory in directories or self._in_recursive(directory, roots=True):
+                continue
+            del self.watched[directory]
+            self.inotify.rm_watch(wd, directory)
+
+    def _in_recursive(self, path, roots=False):
+        return any(
+            (roots and path == root) or path.startswith(root.rstrip(os.sep) + os.sep)
+            for root in self.recursive
+        )
+
+    def read(self, timeout=None):
+        """
+        Waits up to `timeout` seconds (None for ever) for changes
+
+        - returns the paths that were created, changed, moved or removed,
+        or None if there were too many changes to keep track of and events
+        were dropped
+        """
+        if not select.select([self], [], [], timeout)[0]:
+            return set()
+        changed = set()
+        overflow = False
+        settle_by = time.monotonic() + self.MAX_DEBOUNCE_TIME
+        while True:
+            for path, mask in self.inotify.read():
+                if path is None:
+                    overflow = True
+                    continue
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    if self._in_recursive(path):
+                        self._add_tree(path)
+                    # Rather than a file, so no one watches for it
+                    continue
+                if mask & IN_ISDIR:
+                    continue
+                changed.add(path)
+            if time.monotonic() >= settle_by:
+                # What's left is read next time
+                break
+            if not select.select([self], [], [], self.DEBOUNCE_TIME)[0]:
+                break
+        if overflow:
+            # Watches may be missing for directories created meanwhile
+            for root in self.recursive:
+                self._add_tree(root)
+            return None
+        return changed
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _matches_globs(path, globs):
+    for directory, patterns in globs.items():
+        prefix = directory.rstrip(os.sep) + os.sep
+        if not path.startswith(prefix):
+            continue
+        relative = path[len(prefix) :]
+        for pattern in patterns:
+            # fnmatch's `*` matches `/` too, so `**/` only needs to match no directory
+            if fnmatch.fnmatchcase(relative, pattern) or (
+                pattern.startswith("**/") and fnmatch.fnmatchcase(relative, pattern[3:])
+            ):
+                return True
+    return False
+
+
+def _directories(files, globs):
+    """
+    - returns the directories to watch for `files` and `globs`,
+    and those to watch the trees under
+    """
+    return (
+        set(os.path.dirname(path) for path in files),
+        set(
+            directory
+            for directory, patterns in globs.items()
+            if any("**" in pattern for pattern in patterns)
+        ),
+    )
+
+
+class SharedWatcher(object):
+    """
+    A single FileWatcher for the files of several app servers, each of which
+    registers the files it imported and the directory globs (eg. of templates)
+    that new files are matched against. Directories watched for one of them
+    aren't watched again for another
+
+    Only files whose mtime changed, or that were added or removed, are reported
+    """
+
+    def __init__(self):
+        self.watcher = FileWatcher()
+        # By key: the files and the globs registered
+        self.watches = {}
+        # Of every file registered, and of the new ones since
+        self.mtimes = {}
+
+    def fileno(self):
+        return self.watcher.fileno()
+
+    def close(self):
+        self.watcher.close()
+
+    def register(self, key, files, globs, since=None):
+        """
+        Watches `files` and `globs` for `key` rather than what it registered before
+
+        - returns the files that changed after `since`, which whoever registers
+        them may have missed while it started
+        """
+        files = set(files)
+        self.watches[key] = (files, globs)
+        self.watcher.watch(*_directories(files, globs))
+        missed = set()
+        for path in files:
+            mtime = _mtime(path)
+            # A change already recorded may not have been read yet
+            self.mtimes.setdefault(path, mtime)
+            if since and mtime and mtime > since:
+                missed.add(path)
+        return missed
+
+    def unregister(self, key):
+        """
+        Stops watching what only `key` registered, and forgets its files' mtimes
+        """
+        if self.watches.pop(key, None) is None:
+            return
+        directories, recursive = set(), set()
+        for files, globs in self.watches.values():
+            key_directories, key_recursive = _directories(files, globs)
+            directories |= key_directories
+            recursive |= key_recursive
+        self.watcher.keep(directories, recursive)
+        self.mtimes = {
+            path: mtime
+            for path, mtime in self.mtimes.items()
+            if any(
+                path in files or _matches_globs(path, globs)
+                for files, globs in self.watches.values()
+            )
+        }
+
+    def read(self):
+        """
+        - returns the files that changed, by the key they concern
+        """
+        paths = self.watcher.read(timeout=0)
+        if paths is None:
+            # Events were dropped
+            paths = set(self.mtimes)
+        changed = {}
+        for path in paths:
+            keys = [
+                key
+                for key, (files, globs) in self.watches.items()
+                if path in files or _matches_globs(path, globs)
+            ]
+            if not keys:
+                continue
+            mtime = _mtime(path)
+            if mtime == self.mtimes.get(path):
+                continue
+            self.mtimes[path] = mtime
+            for key in keys:
+                changed.setdefault(key, []).append(path)
+        return changed
@@ -0,0 +1,128 @@
+import bisect
+
+
+# Upper bounds in seconds, prometheus' default buckets stretched for test runs
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+PREFIX = "django_spring"
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets, like a prometheus histogram,
+    so that it takes the same memory however long the server runs
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # The last one is for everything over the highest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        - returns an estimate of the `q` quantile, interpolated within
+        the bucket it falls in, or None if nothing was observed
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+def _labels(**labels):
+    return "{%s}" % ",".join('%s="%s"' % item for item in sorted(labels.items()))
+
+
+def render_prometheus(status):
+    """
+    - returns the status the manager sends back for STATUS
+    in prometheus' text exposition format
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        name = "%s_%s" % (PREFIX, name)
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            if value is not None:
+                lines.append("%s%s%s %s" % (name, suffix, _labels(**labels), value))
+
+    envs = status["envs"]
+
+    def per_env(key, scale=1):
+        return [
+            ("", {"env": name}, env[key] * scale if env[key] is not None else None)
+            for name, env in envs.items()
+        ]
+
+    metric(
+        "app_server_state",
+        "gauge",
+        "1 for the state each env's app server is in",
+        [
+            ("", {"env": name, "state": state}, int(env["state"] == state))
+            for name, env in envs.items()
+            for state in ("stopped", "booting", "ready", "restarting")
+        ],
+    )
+    metric("app_server_rss_bytes", "gauge", "RSS of the app server", per_env("rss_kb", 1024))
+    metric(
+        "app_server_memory_bytes",
+        "gauge",
+        "PSS of the app server, its workers and running commands",
+        per_env("memory_kb", 1024),
+    )
+    metric(
+        "app_server_boot_seconds",
+        "gauge",
+        "How long the app server took to be ready",
+        per_env("boot_seconds"),
+    )
+    metric("pool_size", "gauge", "Workers kept forked", per_env("pool_size"))
+    metric("active_commands", "gauge", "Commands running", per_env("active_commands"))
+    metric("queued_commands", "gauge", "Commands waiting to run", per_env("queued_commands"))
+    metric("restarts_total", "counter", "App server restarts", per_env("restarts"))
+
+    for key, help_text in (
+        ("dispatch_seconds", "From the manager accepting a client to its command starting"),
+        ("command_seconds", "How long commands ran for"),
+    ):
+        samples = []
+        for name, env in envs.items():
+            histogram = env[key]
+            for bound, cumulative in histogram["buckets"]:
+                samples.append(("_bucket", {"env": name, "le": bound}, cumulative))
+            samples.append(("_sum", {"env": name}, histogram["sum"]))
+            samples.append(("_count", {"env": name}, histogram["count"]))
+        metric(key, "histogram", help_text, samples)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,178 @@
+import fnmatch
+import hashlib
+import inspect
+import json
+import os
+import threading
+
+from django_spring.config import Config
+from django_spring.utils.logger import get_logger
+
+
+log = get_logger("[MODULE_INDEX]")
+
+
+class ModuleIndex(object):
+    """
+    The python packages under `root` and their modules, cached on disk
+    between runs so that restarts don't walk the whole tree again
+
+    A directory's mtime changes whenever an entry is added to, removed from
+    or renamed in it, so only directories whose mtime changed since they
+    were indexed are listed again, the others are just stat'd. Like
+    `find_packages`, only directories with an `__init__.py` are descended into
+
+    Directories matching one of the `exclude` globs are skipped entirely
+    """
+
+    def __init__(self, root, path, exclude=()):
+        self.root = root
+        self.path = path
+        self.exclude = exclude
+        # directory -> {"mtime", "is_package", "dirs", "modules"}
+        self.entries = {}
+        # How many directories the last `update` had to list
+        self.listed = 0
+        self._modules = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Changing the excludes changes which directories are in the index
+        if data.get("root") == self.root and data.get("exclude") == list(self.exclude):
+            self.entries = data["entries"]
+
+    def save(self):
+        tmp_path = "%s.%s" % (self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"root": self.root, "exclude": list(self.exclude), "entries": self.entries},
+                f,
+            )
+        # Other app servers may be reading or writing it at the same time
+        os.replace(tmp_path, self.path)
+
+    def _excluded(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.exclude)
+
+    def _entry(self, directory):
+        """
+        - returns the index entry of `directory`, listing it again if it changed
+        """
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        entry = self.entries.get(directory)
+        if entry and entry["mtime"] == mtime:
+            return entry
+
+        self.listed += 1
+        entry = {"mtime": mtime, "is_package": False, "dirs": [], "modules": []}
+        try:
+            with os.scandir(directory) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir():
+                        if "." not in dir_entry.name and not self._excluded(
+                            dir_entry.name
+                        ):
+                            entry["dirs"].append(dir_entry.name)
+                        continue
+                    name = inspect.getmodulename(dir_entry.name)
+                    if name == "__init__":
+                        entry["is_package"] = True
+                    elif name and "." not in name:
+                        entry["modules"].append(name)
+        except OSError:
+            return None
+        self.entries[directory] = entry
+        return entry
+
+    def update(self):
+        """
+        Brings the index up to date with the filesystem and saves it
+        """
+        self.listed = 0
+        seen = {}
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            entry = self._entry(directory)
+            if not entry:
+                continue
+            # Directories that aren't packages are kept so they aren't listed
+            # again next time, but nothing below them can be imported
+            seen[directory] = entry
+            if directory == self.root or entry["is_package"]:
+                stack.extend(os.path.join(directory, name) for name in entry["dirs"])
+        changed = self.listed or seen.keys() != self.entries.keys()
+        self.entries = seen
+        self._modules = None
+        if changed:
+            self.save()
+        log("%s directories indexed, %s listed again" % (len(seen), self.listed))
+
+    def packages(self):
+        """
+        - returns the directory and dotted name of every package in the index
+        """
+        root = self.root.rstrip(os.sep) + os.sep
+        for directory, entry in self.entries.items():
+            if directory != self.root and entry["is_package"]:
+                yield directory, directory[len(root) :].replace(os.sep, ".")
+
+    def modules(self):
+        """
+        - returns the names of every package and of the modules directly in them,
+        like `find_packages` combined with `pkgutil.iter_modules`
+        """
+        if self._modules is None:
+            self._modules = []
+            for directory, package in self.packages():
+                self._modules.append(package)
+                entry = self.entries[directory]
+                self._modules.extend(package + "." + name for name in entry["modules"])
+        return self._modules
+
+    def files(self):
+        """
+        - returns the source file of every module in `modules`, and of the
+        modules directly in `root`, by dotted name
+        """
+        files = {}
+        roots = [(self.root, None)] if self.root in self.entries else []
+        for directory, package in roots + list(self.packages()):
+            if package:
+                files[package] = os.path.join(directory, "__init__.py")
+            for name in self.entries[directory]["modules"]:
+                path = os.path.join(directory, name + ".py")
+                if os.path.exists(path):
+                    files[package + "." + name if package else name] = path
+        return files
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def module_index(root):
+    """
+    - returns the up to date index of `root`, shared by everything
+    in this process that looks for the project's modules
+    """
+    with _indexes_lock:
+        if root not in _indexes:
+            key = hashlib.md5(root.encode()).hexdigest()[:12]
+            exclude = [
+                pattern.strip()
+                for pattern in Config.MODULE_INDEX_EXCLUDE.split(",")
+                if pattern.strip()
+            ]
+            index = ModuleIndex(root, Config.MODULE_INDEX_FILE.format(key), exclude)
+            index.load()
+            index.update()
+            _indexes[root] = index
+        return _indexes[root]
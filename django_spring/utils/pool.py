@@ -0,0 +1,121 @@
+import os
+import socket
+import time
+import traceback
+
+from django_spring.utils.processes import reset_signal_wakeup
+from django_spring.utils.socket_data import close
+
+
+class Worker(object):
+    def __init__(self, pid, sock):
+        self.pid = pid
+        self.sock = sock
+        self.client_id = None
+        # Whether its job is stopped when the app server is replaced
+        self.reloadable = False
+        self.forked = time.time()
+        # When it was handed its job
+        self.acquired = None
+
+
+class WorkerPool(object):
+    """
+    Keeps `size` workers forked and waiting for a job
+
+    Each worker runs `target(sock)` in a child forked from the current
+    process, where `sock` is its end of a socketpair that the job and any
+    control messages for it are sent through. Forking ahead of time means a
+    job is handed to a process that is already set up instead of paying for
+    the fork on dispatch
+
+    `inherited()` returns the descriptors the parent holds for others (eg.
+    the clients of queued commands), which the workers close after forking
+    so that they don't keep them open
+    """
+
+    def __init__(self, target, size, inherited=list):
+        self.target = target
+        self.size = size
+        self.inherited = inherited
+        self.idle = []
+        self.busy = {}
+        # Workers that have been told to exit but not reaped yet
+        self.retired = []
+
+    def _fork(self):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                reset_signal_wakeup()
+                # Other workers need to see EOF on their socket
+                # when the parent goes away, so don't hold onto them
+                close([parent_sock] + [w.sock for w in self.workers()])
+                close(self.inherited())
+                self.target(child_sock)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                exit_code = 1
+                traceback.print_exc()
+            finally:
+                os._exit(exit_code)
+
+        child_sock.close()
+        return Worker(pid, parent_sock)
+
+    def workers(self):
+        return self.idle + list(self.busy.values())
+
+    def fill(self):
+        while len(self.idle) < self.size:
+            self.idle.append(self._fork())
+
+    def acquire(self):
+        while self.idle:
+            worker = self.idle.pop(0)
+            if _reap(worker.pid):
+                worker.sock.close()
+                continue
+            break
+        else:
+            worker = self._fork()
+        self.busy[worker.pid] = worker
+        return worker
+
+    def recycle(self):
+        """
+        Retires the idle workers so that `fill` forks fresh ones,
+        for when what they inherited from the parent has gone stale
+        """
+        for worker in self.idle:
+            worker.sock.close()
+            self.retired.append(worker)
+        self.idle = []
+
+    def reap(self):
+        """
+        Collects busy workers that have finished, returning them
+        """
+        self.retired = [w for w in self.retired if not _reap(w.pid)]
+        done = []
+        for pid, worker in list(self.busy.items()):
+            if _reap(pid):
+                worker.sock.close()
+                done.append(self.busy.pop(pid))
+        return done
+
+    def close(self):
+        # idle workers exit once they read EOF on their socket
+        close([w.sock for w in self.idle])
+        self.idle = []
+
+
+def _reap(pid):
+    try:
+        reaped_pid, _ = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        return True
+    return reaped_pid == pid
@@ -1,35 +1,182 @@
+import fcntl
+import fnmatch
 import importlib
+import json
+import logging
 import os
-import pkgutil
-from setuptools import find_packages
+import sys
+import time
 
+from django_spring.config import Config
 from django_spring.utils.logger import get_logger
+from django_spring.utils.module_index import module_index
+from django_spring.utils.processes import rss
 
 
 log = get_logger("[PRELOAD]")
 ROOT_DIR = os.getcwd()
+# Preloads the modules that commands have been importing
+AUTO = "auto"
+# Counts are halved once this many commands have been recorded,
+# so that the hot set follows what is being run lately
+RECORD_WINDOW = 100
 
+# What was imported before preloading, set in the app server and inherited by commands
+_base_modules = None
 
-def preload_views():
+
+def _split(value):
+    return [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+def find_modules(patterns, exclude=()):
     """
-    File watchers only watch files that have been loaded
+    Module names are used as they are, globs (eg. `*.views`)
+    are matched against the modules of the project
 
-    Calling `preload_all_modules` loads all the modules so that changes
-    are detected properly
+    - returns the names of the modules matching `patterns`
     """
-    log("Starting `preload_views`")
-    modules = set()
-    for pkg in find_packages(ROOT_DIR):
-        pkgpath = ROOT_DIR + "/" + pkg.replace(".", "/")
-        for info in pkgutil.iter_modules([pkgpath]):
-            if info.ispkg:
-                continue
-            if info.name != "views":
-                continue
-            modules.add(pkg + "." + info.name)
-    for module in modules:
+    names = set(pattern for pattern in patterns if not _is_glob(pattern))
+    globs = [pattern for pattern in patterns if _is_glob(pattern)]
+    if globs:
+        modules = module_index(ROOT_DIR).modules()
+        names.update(name for name in modules if _matches(name, globs))
+    return sorted(name for name in names if not _matches(name, exclude))
+
+
+def preload_modules(patterns, exclude=()):
+    """
+    Imports the modules matching `patterns`
+
+    - returns how long each module took to import and how much it grew the RSS by
+    """
+    results = []
+    for module in find_modules(patterns, exclude):
+        if module in sys.modules:
+            continue
+        rss_before = rss()
+        start = time.perf_counter()
         try:
             importlib.import_module(module)
         except Exception as e:  # pylint: disable=broad-except
             log("{} failed to load: {}".format(module, e))
+            continue
+        rss_after = rss()
+        result = {
+            "module": module,
+            "ms": round((time.perf_counter() - start) * 1000, 3),
+            "rss_kb": rss_after - rss_before if rss_after is not None else None,
+        }
+        log("{module} took {ms}ms, {rss_kb}kB".format(**result))
+        results.append(result)
+    return results
+
+
+def preload(app_env):
+    """
+    Imports PRELOAD_MODULES in the app server, so that every command
+    forked from it starts with them already imported
+
+    - returns what `preload_modules` does
+    """
+    global _base_modules
+    _base_modules = set(sys.modules)
+
+    patterns = _split(Config.PRELOAD_MODULES)
+    if AUTO in patterns:
+        patterns.remove(AUTO)
+        patterns.extend(hot_modules(app_env))
+    if not patterns:
+        return []
+
+    rss_before = rss()
+    start = time.perf_counter()
+    results = preload_modules(patterns, _split(Config.PRELOAD_EXCLUDE))
+    rss_after = rss()
+    log(
+        "preloaded %s modules in %sms, %skB"
+        % (
+            len(results),
+            round((time.perf_counter() - start) * 1000, 3),
+            rss_after - rss_before if rss_after is not None else None,
+        ),
+        logging.WARN,
+    )
+    return results
+
+
+def _read_record(f):
+    f.seek(0)
+    try:
+        return json.load(f)
+    except ValueError:
+        return {"commands": 0, "modules": {}}
+
+
+def hot_modules(app_env):
+    """
+    - returns the modules that at least half of the recorded commands imported
+    """
+    path = Config.PRELOAD_RECORD_FILE.format(app_env)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        record = _read_record(f)
+    threshold = max(1, record["commands"] / 2.0)
+    return [name for name, count in record["modules"].items() if count >= threshold]
+
+
+def record_imported_modules(app_env):
+    """
+    Adds the modules this command imported on top of the app server's
+    to the record that AUTO preloading picks the hot set from
+    """
+    if _base_modules is None or AUTO not in _split(Config.PRELOAD_MODULES):
+        return
+    modules = [
+        name
+        for name, module in list(sys.modules.items())
+        if module is not None
+        and name not in _base_modules
+        and name != "__main__"
+        and not name.startswith("django_spring")
+    ]
+
+    path = Config.PRELOAD_RECORD_FILE.format(app_env)
+    with open(path, "a+") as f:
+        # Commands that run at the same time all write to it
+        fcntl.flock(f, fcntl.LOCK_EX)
+        record = _read_record(f)
+        if record["commands"] >= RECORD_WINDOW:
+            record["commands"] //= 2
+            record["modules"] = {
+                name: count // 2
+                for name, count in record["modules"].items()
+                if count // 2
+            }
+        record["commands"] += 1
+        for name in modules:
+            record["modules"][name] = record["modules"].get(name, 0) + 1
+        f.seek(0)
+        f.truncate()
+        json.dump(record, f)
+
+
+def preload_views():
+    """
+    File watchers only watch files that have been loaded
+
+    Calling `preload_views` loads all the views so that changes
+    are detected properly
+    """
+    log("Starting `preload_views`")
+    preload_modules(["*.views"])
     log("Done `preload_views`")
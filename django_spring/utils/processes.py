@@ -1,5 +1,9 @@
+import ctypes
+import ctypes.util
+import gc
 import os
 import signal
+import threading
 from contextlib import contextmanager
 
 
@@ -23,6 +27,166 @@ def signal_handler(*signals):
         signal.signal(s, handler)
 
 
+@contextmanager
+def signal_wakeup_fd(*signals):
+    """
+    Yields the read end of a pipe that a byte is written to whenever
+    a signal arrives, so that signals (eg. SIGCHLD) can be waited on
+    with select alongside sockets
+
+    `signals` that have no python handler get a no-op one,
+    as the pipe is only written to for handled signals
+    """
+    r, w = os.pipe()
+    os.set_blocking(r, False)
+    os.set_blocking(w, False)
+    original_signals = dict()
+    for s in signals:
+        original_signals[s] = signal.getsignal(s)
+        if original_signals[s] in (signal.SIG_DFL, signal.SIG_IGN, None):
+            signal.signal(s, _ignore_signal)
+    original_fd = signal.set_wakeup_fd(w)
+
+    try:
+        yield r
+    finally:
+        signal.set_wakeup_fd(original_fd)
+        for s, handler in original_signals.items():
+            signal.signal(s, handler if handler is not None else signal.SIG_DFL)
+        os.close(r)
+        os.close(w)
+
+
+def _ignore_signal(_sig, _frame):
+    pass
+
+
+def reset_signal_wakeup():
+    """
+    Forked children inherit the wakeup fd of their parent,
+    which would wake up the parent for the child's signals
+    """
+    signal.set_wakeup_fd(-1)
+    if signal.getsignal(signal.SIGCHLD) is _ignore_signal:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+
+def drain_fd(fd):
+    try:
+        while os.read(fd, 1024):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def exit_code_from_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def rss(pid="self"):
+    """
+    - returns the resident set size of the process `pid` in kB,
+    or None where /proc isn't available
+    """
+    try:
+        with open("/proc/%s/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return None
+
+
+def _smaps_rollup(pid):
+    fields = {}
+    with open("/proc/%s/smaps_rollup" % pid) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields
+
+
+def memory_usage():
+    """
+    - returns the RSS of this process in kB, split into what is shared with
+    other processes (eg. pages still shared with the parent it was forked from)
+    and what is private to it, or None where /proc isn't available
+    """
+    try:
+        fields = _smaps_rollup("self")
+    except (OSError, ValueError):
+        return None
+    return {
+        "rss_kb": fields.get("Rss", 0),
+        "shared_kb": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        "private_kb": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def _child_pids(pid):
+    try:
+        with open("/proc/%s/task/%s/children" % (pid, pid)) as f:
+            return [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        return []
+
+
+def tree_memory(pid):
+    """
+    Forked processes share most of their pages, so their RSS adds up to far
+    more than they use together. Their PSS splits each shared page between
+    the processes sharing it instead
+
+    - returns the PSS of `pid` and all its descendants in kB,
+    or None where /proc isn't available
+    """
+    total = None
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            total = (total or 0) + _smaps_rollup(pid).get("Pss", 0)
+        except (OSError, ValueError):
+            continue
+        pids.extend(_child_pids(pid))
+    return total
+
+
+def mem_available():
+    """
+    - returns how much memory the system can give out without swapping in kB,
+    or None where /proc isn't available
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def freeze_heap():
+    """
+    Prepares the heap to be shared with children forked from here on
+
+    Everything garbage is collected and what's left is moved to the
+    permanent generation, which the collector never scans, so collections
+    in the children don't write to (and so copy) the pages they share with
+    the parent. Freed memory is handed back to the OS where glibc allows it
+    """
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    libc_name = ctypes.util.find_library("c")
+    if libc_name:
+        libc = ctypes.CDLL(libc_name)
+        if hasattr(libc, "malloc_trim"):
+            libc.malloc_trim(0)
+
+
 def pid_is_alive(pid):
     try:
         os.kill(pid, 0)
@@ -31,3 +195,36 @@ def pid_is_alive(pid):
     except OSError:
         return False
     return True
+
+
+class FdEvent(object):
+    """
+    A `threading.Event` that can also be waited on with select
+    since `fileno` becomes readable once it is set, along with
+    the `reason` it was first set for
+    """
+
+    def __init__(self):
+        self.reason = None
+        self._event = threading.Event()
+        self._r, self._w = os.pipe()
+        os.set_blocking(self._r, False)
+
+    def fileno(self):
+        return self._r
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def set(self, reason=None):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+            os.write(self._w, b"1")
+
+    def clear(self):
+        self._event.clear()
+        drain_fd(self._r)
+        # `set` may have run in between, its byte mustn't be lost
+        if self._event.is_set():
+            os.write(self._w, b"1")
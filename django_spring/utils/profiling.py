@@ -0,0 +1,217 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from django_spring.config import Config
+from django_spring.utils.logger import get_logger
+
+
+log = get_logger("[PROFILE]")
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+class ImportTimer(object):
+    """
+    A meta path finder that times the loading of every module imported
+    while it is installed, like `python -X importtime`
+
+    It finds nothing itself, it asks the finders after it and wraps the
+    loader of the spec they return. A module's self time excludes the
+    modules it imported
+    """
+
+    def __init__(self):
+        # module name -> [self time, cumulative time]
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = _TimedLoader(spec.loader, self)
+        return spec
+
+    def time(self, name, fn, *args):
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                timing = self.timings.setdefault(name, [0.0, 0.0])
+                timing[0] += elapsed - children
+                timing[1] += elapsed
+
+    def report(self):
+        timings = sorted(self.timings.items(), key=lambda item: -item[1][1])
+        return [
+            {"module": name, "self_ms": _ms(own), "cumulative_ms": _ms(cumulative)}
+            for name, (own, cumulative) in timings
+        ]
+
+
+class _TimedLoader(object):
+    def __init__(self, loader, timer):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, key):
+        return getattr(self._loader, key)
+
+    def create_module(self, spec):
+        return self._timer.time(spec.name, self._loader.create_module, spec)
+
+    def exec_module(self, module):
+        # The module only ever sees its real loader
+        module.__loader__ = self._loader
+        if getattr(module, "__spec__", None) is not None:
+            module.__spec__.loader = self._loader
+        self._timer.time(module.__name__, self._loader.exec_module, module)
+
+
+class StartupProfile(object):
+    """
+    Collects how long an app server takes to start: per module import
+    times, per app `AppConfig.ready()` times and the time of each phase
+
+    Imports and `ready()` are only timed when profiling is `enabled`,
+    in which case `write` saves everything as JSON to PROFILE_STARTUP_FILE
+    """
+
+    def __init__(self, app_env, enabled=False):
+        self.app_env = app_env
+        self.enabled = enabled
+        self.imports = ImportTimer()
+        self.app_ready = {}
+        self.phases = {}
+        self.preloaded = []
+        self.started = time.perf_counter()
+        self._get_app_configs = None
+
+    def install(self):
+        if not self.enabled:
+            return
+        sys.meta_path.insert(0, self.imports)
+        # Either thread may be the one to run `django.setup()`
+        from django.apps import apps
+
+        self._get_app_configs = apps.get_app_configs
+        apps.get_app_configs = self._timed_app_configs
+
+    def uninstall(self):
+        if not self.enabled:
+            return
+        from django.apps import apps
+
+        if self.imports in sys.meta_path:
+            sys.meta_path.remove(self.imports)
+        if self._get_app_configs:
+            del apps.get_app_configs
+            self._get_app_configs = None
+        for app_config in apps.app_configs.values():
+            vars(app_config).pop("ready", None)
+
+    def _timed_app_configs(self):
+        app_configs = self._get_app_configs()
+        for app_config in app_configs:
+            if "ready" not in vars(app_config):
+                app_config.ready = self._timed_ready(app_config)
+        return app_configs
+
+    def _timed_ready(self, app_config):
+        ready = app_config.ready
+
+        def _ready():
+            start = time.perf_counter()
+            try:
+                return ready()
+            finally:
+                self.app_ready[app_config.label] = _ms(time.perf_counter() - start)
+
+        return _ready
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = _ms(time.perf_counter() - start)
+
+    def write(self):
+        if not self.enabled:
+            return
+        self.uninstall()
+        path = Config.PROFILE_STARTUP_FILE.format(self.app_env)
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "app_env": self.app_env,
+                    "total_ms": _ms(time.perf_counter() - self.started),
+                    "phases": self.phases,
+                    "app_ready": self.app_ready,
+                    "preloaded": self.preloaded,
+                    "imports": self.imports.report(),
+                },
+                f,
+                indent=2,
+            )
+        log("startup profile written to %s" % path)
+
+
+class FirstWriteFile(object):
+    """
+    Wraps a file, calling `callback` the first time it is written to
+    """
+
+    def __init__(self, file, callback):
+        self._file = file
+        self._callback = callback
+
+    def __getattr__(self, key):
+        return getattr(self._file, key)
+
+    def write(self, data):
+        if self._callback:
+            callback, self._callback = self._callback, None
+            callback()
+        return self._file.write(data)
+
+
+def write_command_profile(command, app_env, exit_code, timings, memory=None):
+    """
+    Appends the timestamps of a command's phases, along with how long after
+    the manager accepted the client each of them happened, to PROFILE_COMMANDS_FILE
+    """
+    start = timings.get("accepted") or min(timings.values())
+    record = {
+        "command": command,
+        "app_env": app_env,
+        "exit_code": exit_code,
+        "memory": memory,
+        "timings": timings,
+        "since_accepted_ms": {
+            phase: _ms(t - start)
+            for phase, t in sorted(timings.items(), key=lambda item: item[1])
+        },
+    }
+    with open(Config.PROFILE_COMMANDS_FILE, "a") as f:
+        f.write(json.dumps(record) + "\n")
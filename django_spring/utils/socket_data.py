@@ -1,11 +1,41 @@
+import array
+import errno
+import fcntl
 import functools
 import json
 import os
 import socket
+import struct
+import termios
 import time
 from contextlib import contextmanager
 
 
+HAS_SPLICE = hasattr(os, "splice")
+MIN_READ_SIZE = 64 * 1024
+MAX_READ_SIZE = 1024 * 1024
+
+# Everything sent over the sockets is framed: the frame's type,
+# the session it belongs to and the length of its payload
+FRAME_HEADER = struct.Struct("!BII")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Frame types
+CONTROL = 1  # a JSON object
+STDIN = 2  # an empty one means EOF
+STDOUT = 3
+STDERR = 4
+EXIT = 5  # EXIT_STATUS
+RESIZE = 6  # TERMINAL_SIZE
+EXIT_STATUS = struct.Struct("!i")
+# Columns, lines
+TERMINAL_SIZE = struct.Struct("!HH")
+
+
+class ConnectionClosed(ValueError):
+    # A ValueError, which is what callers have always caught for closed sockets
+    pass
+
+
 @contextmanager
 def bind(path):
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -40,13 +70,17 @@ def close(socks):
             os.close(sock)
 
 
-def write_json(data, fd):
-    if hasattr(fd, "fileno"):
-        fd = fd.fileno()
-    as_json = json.dumps(data)
-    len_s = "%16s" % len(as_json)
-    os.write(fd, len_s.encode())
-    os.write(fd, as_json.encode())
+def _fileno(sock):
+    return sock.fileno() if hasattr(sock, "fileno") else sock
+
+
+def frame(frame_type, payload=b"", session=0):
+    return FRAME_HEADER.pack(frame_type, session, len(payload)) + payload
+
+
+def write_frame(fd, frame_type, payload=b"", session=0):
+    # In a single write, so that frames from different threads can't interleave
+    write_all(_fileno(fd), frame(frame_type, payload, session))
 
 
 def _get_read_fn(sock):
@@ -59,45 +93,208 @@ def _get_read_fn(sock):
     return read
 
 
-def read_json(sock):
+def _read_exact(sock, size):
     """
-    Reads a JSON object from the socket:
-    - 16 bytes to get the length of the JSON string
-    - n bytes for the JSON string
+    Reads never return more than asked for, so nothing that follows
+    (eg. file descriptors sent with `send_fds`) is consumed
+
+    - returns exactly `size` bytes read from `sock`
     """
     read_fn = _get_read_fn(sock)
-    data_len = int(read_fn(16).decode().strip())
-    data = read_fn(data_len).decode()
-    return json.loads(data)
+    chunks = []
+    while size:
+        chunk = read_fn(size)
+        if not chunk:
+            raise ConnectionClosed("connection closed %s bytes short" % size)
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
 
 
-def fd_redirect(sock_in, sock_out, read_sizes=None):
-    read_size = (read_sizes or {}).get(sock_in, 1024)
-    read_sock_in = _get_read_fn(sock_in)
-    data = read_sock_in(read_size)
-    if not data:
-        return False
-    if hasattr(sock_out, "fileno"):
-        sock_out = sock_out.fileno()
-    os.write(sock_out, data)
-    return True
+def read_frame(sock):
+    """
+    - returns the type, session and payload of the next frame on `sock`
+    """
+    frame_type, session, size = FRAME_HEADER.unpack(
+        _read_exact(sock, FRAME_HEADER.size)
+    )
+    if size > MAX_FRAME_SIZE:
+        raise ValueError("frame of %s bytes is too large" % size)
+    return frame_type, session, _read_exact(sock, size)
 
 
-def fd_redirect_list(socks_in, redirect_map, read_sizes=None):
+def write_json(data, fd, session=0):
+    write_frame(fd, CONTROL, json.dumps(data).encode(), session)
+
+
+def read_json(sock):
+    """
+    Reads a JSON object sent in a CONTROL frame with `write_json`
+    """
+    frame_type, _, payload = read_frame(sock)
+    if frame_type != CONTROL:
+        raise ValueError("expected a control frame, got one of type %s" % frame_type)
+    return json.loads(payload.decode())
+
+
+class FrameReader(object):
+    """
+    Splits what is read from `sock` into frames, so that a socket select says
+    is readable can be read from without blocking on a frame that only partly
+    arrived yet
     """
-    Redirects every descriptor in `socks_in` according to the `redirect_map`
-    dictionary which maps from input descriptors to output descriptors
 
-    `read_sizes` is a dictionary that can return the number of bytes to
-    read for a given input descriptor
+    def __init__(self, sock, read_size=MIN_READ_SIZE):
+        self.sock = sock
+        self.read_size = read_size
+        self.buffer = bytearray()
+
+    def read(self):
+        """
+        - returns the frames that what could be read completes,
+        or None once `sock` is closed
+        """
+        data = _get_read_fn(self.sock)(self.read_size)
+        if not data:
+            return None
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            frame_type, session, size = FRAME_HEADER.unpack_from(self.buffer)
+            end = FRAME_HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            frames.append((frame_type, session, bytes(self.buffer[FRAME_HEADER.size : end])))
+            del self.buffer[:end]
+        return frames
 
-    - returns True iff every redirect succeeds on redirecting data
-    ie. will return false if a descriptor is closed
+
+def send_fds(sock, fds):
+    """
+    Sends the file descriptors `fds` over the unix socket `sock`
     """
-    is_success = True
-    for sock_in in socks_in:
-        is_success &= fd_redirect(sock_in, redirect_map[sock_in], read_sizes)
-    return is_success
+    sock.sendmsg(
+        [b"F"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+    )
+
+
+def recv_fds(sock, max_fds):
+    """
+    Receives up to `max_fds` file descriptors sent with `send_fds`
+
+    - returns an empty list if the socket is closed
+    """
+    fds = array.array("i")
+    _, ancdata, _, _ = sock.recvmsg(1, socket.CMSG_LEN(max_fds * fds.itemsize))
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[: len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+    return list(fds)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+class Relay(object):
+    """
+    Redirects data from input descriptors to output descriptors
+    according to the `redirect_map` dictionary
+
+    Reads start at MIN_READ_SIZE bytes and double, up to MAX_READ_SIZE,
+    whenever a read fills the buffer. Where the kernel allows it (one side
+    is a pipe) the data is moved with splice(2), so it is never copied
+    into python
+
+    `read_sizes` is a dictionary that can pin the number of bytes to
+    read for a given input descriptor, and `frame_types` one that makes
+    what is read from an input descriptor be sent as frames of that type
+    """
+
+    def __init__(self, redirect_map, read_sizes=None, frame_types=None):
+        self.redirect_map = redirect_map
+        self.read_sizes = dict(read_sizes or {})
+        self.frame_types = dict(frame_types or {})
+        self.can_splice = {}
+
+    def _read_size(self, sock_in):
+        return self.read_sizes.get(sock_in, MIN_READ_SIZE)
+
+    def _adapt(self, sock_in, read_size, num_read):
+        if num_read == read_size and read_size < MAX_READ_SIZE:
+            self.read_sizes[sock_in] = read_size * 2
+
+    def _splice(self, sock_in, sock_out, read_size):
+        try:
+            return os.splice(_fileno(sock_in), _fileno(sock_out), read_size)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+        self.can_splice[sock_in] = False
+        return None
+
+    def _splice_frame(self, sock_in, sock_out, frame_type, read_size):
+        """
+        The frame's length has to be known before its payload is spliced,
+        so only what is already waiting in `sock_in` is sent
+
+        - returns how many bytes were sent, 0 if none were waiting
+        """
+        waiting = array.array("i", [0])
+        fcntl.ioctl(_fileno(sock_in), termios.FIONREAD, waiting, True)
+        size = min(read_size, waiting[0])
+        if not size:
+            return 0
+        write_all(_fileno(sock_out), FRAME_HEADER.pack(frame_type, 0, size))
+        sent = 0
+        while sent < size:
+            num_sent = None
+            if self.can_splice[sock_in]:
+                num_sent = self._splice(sock_in, sock_out, size - sent)
+            if num_sent is None:
+                data = os.read(_fileno(sock_in), size - sent)
+                write_all(_fileno(sock_out), data)
+                num_sent = len(data)
+            sent += num_sent
+        return sent
+
+    def __call__(self, sock_in):
+        """
+        Redirects the data available on `sock_in`
+
+        - returns False iff `sock_in` is closed
+        """
+        sock_out = self.redirect_map[sock_in]
+        read_size = self._read_size(sock_in)
+        frame_type = self.frame_types.get(sock_in)
+        if frame_type:
+            if self.can_splice.setdefault(sock_in, HAS_SPLICE):
+                num_read = self._splice_frame(sock_in, sock_out, frame_type, read_size)
+                if num_read:
+                    self._adapt(sock_in, read_size, num_read)
+                    return True
+            # Readable with nothing waiting means it was closed, which the read confirms
+            data = _get_read_fn(sock_in)(read_size)
+            if not data:
+                return False
+            write_frame(sock_out, frame_type, data)
+            self._adapt(sock_in, read_size, len(data))
+            return True
+
+        if self.can_splice.setdefault(sock_in, HAS_SPLICE):
+            num_read = self._splice(sock_in, sock_out, read_size)
+            if num_read is not None:
+                self._adapt(sock_in, read_size, num_read)
+                return num_read > 0
+
+        data = _get_read_fn(sock_in)(read_size)
+        if not data:
+            return False
+        write_all(_fileno(sock_out), data)
+        self._adapt(sock_in, read_size, len(data))
+        return True
 
 
 def connect(path, max_attempts=5, wait_time=0.2):
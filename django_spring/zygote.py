@@ -0,0 +1,253 @@
+import importlib
+import logging
+import os
+import runpy
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import deque
+
+from django_spring.config import Config, reload_config
+from django_spring.utils import logger
+from django_spring.utils.logger import get_logger
+from django_spring.utils.processes import (
+    drain_fd,
+    exit_code_from_status,
+    signal_wakeup_fd,
+)
+from django_spring.utils.socket_data import read_json, recv_fds, send_fds, write_json
+
+
+# What every app server imports whatever its settings, none of which
+# reads the settings or the environment when imported
+PRELOAD_MODULES = [
+    "django",
+    "django.apps",
+    "django.conf",
+    "django.core.handlers.wsgi",
+    "django.core.management",
+    "django.db.models",
+    "django.forms",
+    "django.http",
+    "django.template",
+    "django.template.loader",
+    "django.test",
+    "django.test.runner",
+    "django.urls",
+    "django.views.generic",
+]
+
+log = get_logger("[ZYGOTE]")
+
+
+def preload_modules():
+    names = PRELOAD_MODULES + [
+        name.strip() for name in Config.ZYGOTE_PRELOAD.split(",") if name.strip()
+    ]
+    started = time.perf_counter()
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            # Eg. it needs the settings, the app servers import it themselves
+            log("can't preload %s: %r" % (name, e), logging.WARN)
+    log("preloaded in %.2fs" % (time.perf_counter() - started))
+
+
+def _report_exits(zygote_sock):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if not pid:
+            return
+        write_json({"exited": pid, "status": exit_code_from_status(status)}, zygote_sock)
+
+
+def serve(zygote_sock):
+    """
+    Forks an app server for every request the manager sends, and tells
+    the manager about the ones that exit
+
+    - returns in the forked children only, the request and the app
+    server's end of its control socket
+    """
+    with signal_wakeup_fd(
+        signal.SIGCHLD
+    ) as child_exit_fd, selectors.DefaultSelector() as selector:
+        selector.register(zygote_sock, selectors.EVENT_READ)
+        selector.register(child_exit_fd, selectors.EVENT_READ)
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj == child_exit_fd:
+                    drain_fd(child_exit_fd)
+                    _report_exits(zygote_sock)
+                    continue
+                try:
+                    msg = read_json(zygote_sock)
+                    ctl_fd = recv_fds(zygote_sock, 1)[0]
+                except (ValueError, IndexError):
+                    # The manager is gone
+                    return None
+                pid = os.fork()
+                if not pid:
+                    return msg, ctl_fd
+                os.close(ctl_fd)
+                write_json({"spawned": pid}, zygote_sock)
+
+
+def run_app_server(msg, ctl_fd):
+    """
+    Runs app_server.py in this process as if it had been started
+    with the environment and arguments in `msg`
+    """
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    os.environ.clear()
+    os.environ.update(msg["env"])
+    # Eg. the env's DJANGO_SETTINGS_MODULE rather than the zygote's
+    reload_config()
+    logger.LOG_LEVEL = getattr(logging, Config.LOG_LEVEL)
+    sys.argv = msg["argv"] + [str(ctl_fd)]
+    sys.path[0] = os.path.dirname(sys.argv[0])
+    runpy.run_path(sys.argv[0], run_name="__main__")
+
+
+class ZygoteProcess(object):
+    """
+    An app server forked by the zygote, with what the manager uses of
+    `subprocess.Popen`. It isn't the manager's child, the zygote says
+    when it exits
+
+    Its `pid` is None until the zygote has forked it
+    """
+
+    def __init__(self, zygote):
+        self.zygote = zygote
+        self.pid = None
+        self.returncode = None
+        # Sent once it's forked
+        self.pending_signal = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None and self.zygote.read():
+            pass
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is not None:
+            return
+        if self.pid is None:
+            self.pending_signal = sig
+        else:
+            os.kill(self.pid, sig)
+
+    def _spawned(self, pid):
+        self.pid = pid
+        if self.pending_signal:
+            self.send_signal(self.pending_signal)
+
+
+class Zygote(object):
+    """
+    The manager's side of a process that imports django once, then
+    forks app servers that only need to import the project and set
+    up django, rather than starting a python interpreter for each
+    """
+
+    def __init__(self):
+        self.sock, zygote_sock = socket.socketpair()
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable]
+                + ["-W%s" % o for o in sys.warnoptions]
+                + [os.path.abspath(__file__), str(zygote_sock.fileno())],
+                pass_fds=[zygote_sock.fileno()],
+            )
+        finally:
+            zygote_sock.close()
+        self.processes = {}
+        # Requested but not forked yet, in the order the zygote forks them
+        self.pending = deque()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def spawn(self, argv, env, ctl_sock):
+        """
+        Has the zygote fork an app server that runs `argv` (without the python
+        executable) with the environment `env`, its control socket's number
+        appended. The zygote says which process it forked once it has, which
+        `read` handles, as it may still be importing django
+
+        - returns its ZygoteProcess
+        """
+        write_json({"argv": argv, "env": env}, self.sock)
+        send_fds(self.sock, [ctl_sock.fileno()])
+        process = ZygoteProcess(self)
+        self.pending.append(process)
+        return process
+
+    def read(self):
+        """
+        Reads what the zygote sent, eg. that one of its app servers exited
+
+        - returns False if the zygote is gone, its app servers are
+        then stopped and count as exited
+        """
+        try:
+            self._handle(read_json(self.sock))
+        except (OSError, ValueError):
+            # Reset rather than closed when it dies with our messages unread
+            self._lost()
+            return False
+        return True
+
+    def _handle(self, msg):
+        if "spawned" in msg:
+            process = self.pending.popleft()
+            self.processes[msg["spawned"]] = process
+            process._spawned(msg["spawned"])
+        elif "exited" in msg:
+            process = self.processes.pop(msg["exited"], None)
+            if process:
+                process.returncode = msg["status"]
+
+    def _lost(self):
+        for process in self.processes.values():
+            try:
+                os.kill(process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            process.returncode = -signal.SIGTERM
+        self.processes.clear()
+        # Never forked, they're started again without the zygote
+        for process in self.pending:
+            process.returncode = Config.RESTART_EXIT_CODE
+        self.pending.clear()
+
+    def close(self):
+        self.sock.close()
+        self._lost()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+if __name__ == "__main__":
+    # Interrupting `spring start` interrupts the app servers, then the
+    # manager closes the socket once they have exited
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    zygote_sock = socket.socket(fileno=int(sys.argv[1]))
+    preload_modules()
+    spawned = serve(zygote_sock)
+    zygote_sock.close()
+    if spawned:
+        run_app_server(*spawned)